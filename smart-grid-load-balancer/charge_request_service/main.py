@@ -1,19 +1,192 @@
 from flask import Flask, request, jsonify
 import requests
+import itertools
 import logging
 import os
+import random
+import threading
+import time
+import uuid
 from datetime import datetime
+from grid_logging import setup_logging
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+setup_logging('charge_request_service')
 logger = logging.getLogger(__name__)
 
 LOAD_BALANCER_URL = os.getenv('LOAD_BALANCER_URL', 'http://load_balancer:8080')
+# Comma-separated active-active replicas; defaults to the single LOAD_BALANCER_URL
+LOAD_BALANCER_URLS = [url for url in os.getenv('LOAD_BALANCER_URLS', LOAD_BALANCER_URL).split(',') if url]
+
+# Dispatch straight to substations using the balancer's routing table (FAST_PATH=0 disables)
+FAST_PATH = os.getenv('FAST_PATH', '1') != '0'
+ROUTING_TABLE_INTERVAL = float(os.getenv('ROUTING_TABLE_INTERVAL', '1'))
+MAX_PENDING_REPORTS = 10000
+
+replica_counter = itertools.count()
+
+# Latest routing table from the balancer as published (version, substation entries, fetch time
+# and ttl), plus the headroom we work from: the published headroom minus what we dispatched or
+# saw rejected since, reset from the published entries on every refresh
+routing_table = {'version': None, 'published': [], 'headroom': {}, 'fetched_at': 0.0, 'ttl': 10.0}
+# Direct dispatches not yet reported to the balancer
+dispatch_reports = []
+table_lock = threading.Lock()
+
+def post_to_load_balancer(path, payload):
+    """
+    Spread requests round-robin across the load balancer replicas. A replica that cannot be
+    reached is skipped; requests that reached a replica are never retried on another one.
+    """
+    start = next(replica_counter)
+    last_error = None
+    for attempt in range(len(LOAD_BALANCER_URLS)):
+        url = LOAD_BALANCER_URLS[(start + attempt) % len(LOAD_BALANCER_URLS)]
+        try:
+            return requests.post(f"{url}{path}", json=payload, timeout=30)
+        except requests.ConnectionError as e:
+            logger.warning("Load balancer replica %s unreachable: %s", url, e, extra={'event': 'replica_unreachable'})
+            last_error = e
+    raise last_error
+
+def flush_dispatch_reports(url):
+    """Report direct dispatches to a balancer replica; they are kept for the next try on failure"""
+    with table_lock:
+        reports = dispatch_reports[:]
+        del dispatch_reports[:]
+    if not reports:
+        return
+    try:
+        response = requests.post(f"{url}/dispatch_report", json={'dispatches': reports}, timeout=2)
+        response.raise_for_status()
+    except requests.RequestException:
+        # Re-sent reports keep their ids, so the balancer drops any it already recorded
+        with table_lock:
+            dispatch_reports[:0] = reports
+            del dispatch_reports[:-MAX_PENDING_REPORTS]
+        raise
+
+def refresh_routing_table():
+    """
+    Background thread reporting direct dispatches and keeping the routing table current.
+    Sticks to one replica while it answers, moving to the next one when it does not.
+    """
+    replica = 0
+    while True:
+        try:
+            for attempt in range(len(LOAD_BALANCER_URLS)):
+                url = LOAD_BALANCER_URLS[replica]
+                try:
+                    flush_dispatch_reports(url)
+                except requests.RequestException as e:
+                    logger.warning("Reporting dispatches to %s failed: %s", url, e, extra={'event': 'dispatch_report_error'})
+                try:
+                    response = requests.get(f"{url}/routing_table",
+                                            params={'since': routing_table['version'] or ''}, timeout=2)
+                except requests.RequestException as e:
+                    logger.warning("Routing table refresh from %s failed: %s", url, e, extra={'event': 'routing_table_error'})
+                    replica = (replica + 1) % len(LOAD_BALANCER_URLS)
+                    continue
+                if response.status_code in (200, 304):
+                    table = response.json() if response.status_code == 200 else None
+                    with table_lock:
+                        if table is not None:
+                            routing_table.update(version=table['version'], published=table['substations'],
+                                                 ttl=table.get('ttl', routing_table['ttl']))
+                        routing_table['headroom'] = {entry['id']: entry['headroom'] for entry in routing_table['published']}
+                        routing_table['fetched_at'] = time.time()
+                break
+            
+        except Exception as e:
+            logger.error("Error in routing table thread: %s", e, extra={'event': 'routing_table_error'})
+        time.sleep(ROUTING_TABLE_INTERVAL)
+
+def pick_substation(charge_amount):
+    """
+    Weighted random choice among substations whose headroom fits the charge.
+    Returns None when the table is stale or nothing fits.
+    """
+    with table_lock:
+        if time.time() - routing_table['fetched_at'] > routing_table['ttl']:
+            return None
+        headroom = routing_table['headroom']
+        candidates = [entry for entry in routing_table['published'] if headroom[entry['id']] >= charge_amount]
+        if not candidates:
+            return None
+        weights = [max(entry['weight'], 1) for entry in candidates]
+        substation = random.choices(candidates, weights=weights)[0]
+        # Spend the headroom locally so bursts between refreshes spread out
+        headroom[substation['id']] -= charge_amount
+        return substation
+
+def record_dispatch(substation_id, charge_amount, status_code, dispatched_at, full=False):
+    """Queue a direct dispatch for the balancer; a full substation is skipped until the next refresh"""
+    with table_lock:
+        dispatch_reports.append({'id': uuid.uuid4().hex, 'substation_id': substation_id, 'charge_amount': charge_amount,
+                                 'status_code': status_code, 'dispatched_at': dispatched_at})
+        del dispatch_reports[:-MAX_PENDING_REPORTS]
+        if full:
+            routing_table['headroom'][substation_id] = 0.0
+
+def send_to_substation(substation, data, charge_amount):
+    """
+    Send a charge straight to a substation from the routing table.
+    Returns (body, status code) for the client, or None when the substation did not admit the
+    charge, so it can safely go elsewhere.
+    """
+    dispatched_at = time.time()
+    try:
+        response = requests.post(f"{substation['url']}/charge", json=data, timeout=30)
+    except requests.ConnectionError as e:
+        # The charge never reached the substation
+        logger.warning("Substation %s unreachable: %s", substation['id'], e, extra={'event': 'substation_unreachable'})
+        with table_lock:
+            routing_table['headroom'][substation['id']] = 0.0
+        return None
+    except requests.RequestException as e:
+        # The substation may have admitted it; sending it anywhere else could admit it twice
+        logger.error("Substation %s did not answer: %s", substation['id'], e, extra={'event': 'substation_error'})
+        return {'error': 'Substation did not respond; the charge may have been admitted'}, 504
+    
+    if response.status_code == 200:
+        record_dispatch(substation['id'], charge_amount, 200, dispatched_at)
+        result = response.json()
+        result['routed_by'] = 'gateway'
+        result['substation_id'] = substation['id']
+        return result, 200
+    if response.status_code == 503 and 'Insufficient capacity' in response.text:
+        record_dispatch(substation['id'], charge_amount, 503, dispatched_at, full=True)
+    return None
+
+def dispatch_direct(data):
+    """Dispatch to a substation picked from a fresh routing table; None means use the balancer"""
+    charge_amount = float(data['charge_amount'])
+    substation = pick_substation(charge_amount)
+    if substation is None:
+        return None
+    return send_to_substation(substation, data, charge_amount)
+
+def dispatch_stale(data):
+    """
+    Last resort while no balancer replica answers. The local headroom cannot be refreshed
+    during the outage, so the charge is offered to every substation of the last table, highest
+    weight first, and their own admission checks decide.
+    """
+    charge_amount = float(data['charge_amount'])
+    with table_lock:
+        candidates = sorted(routing_table['published'], key=lambda entry: entry['weight'], reverse=True)
+    for substation in candidates:
+        dispatched = send_to_substation(substation, data, charge_amount)
+        if dispatched is not None:
+            return dispatched
+    return None
 
 @app.route('/charge', methods=['POST'])
 def charge_request():
     """
-    Handles incoming EV charging requests and forwards them to the load balancer
+    Handles incoming EV charging requests. They go straight to a substation picked from
+    the routing table, and through the load balancer when the table is stale or the
+    substation rejects them
     """
     try:
         data = request.get_json()
@@ -28,27 +201,88 @@ def charge_request():
         
         data['timestamp'] = datetime.now().isoformat()
         
-        logger.info(f"Received charge request for vehicle {data['vehicle_id']}")
+        logger.info("Received charge request for vehicle %s", data['vehicle_id'],
+                    extra={'event': 'charge_received', 'fields': {'vehicle_id': data['vehicle_id']}})
+        
+        dispatched = dispatch_direct(data) if FAST_PATH else None
+        if dispatched is not None:
+            result, status_code = dispatched
+            if status_code == 200:
+                logger.info("Charge request dispatched directly to %s", result['substation_id'],
+                            extra={'event': 'charge_routed',
+                                   'fields': {'vehicle_id': data['vehicle_id'],
+                                              'substation_id': result['substation_id']}})
+            return jsonify(result), status_code
         
-        response = requests.post(
-            f"{LOAD_BALANCER_URL}/route_charge",
-            json=data,
-            timeout=30
-        )
+        try:
+            response = post_to_load_balancer('/route_charge', data)
+        except requests.ConnectionError:
+            # No replica reachable: keep admitting from the last table we have, however old
+            dispatched = dispatch_stale(data) if FAST_PATH else None
+            if dispatched is None:
+                raise
+            logger.warning("Load balancer unreachable, dispatched %s from a stale routing table",
+                           data['vehicle_id'], extra={'event': 'charge_routed_stale'})
+            return jsonify(dispatched[0]), dispatched[1]
         
         if response.status_code == 200:
             result = response.json()
-            logger.info(f"Charge request routed successfully to {result.get('substation_id')}")
+            logger.info("Charge request routed successfully to %s", result.get('substation_id'),
+                        extra={'event': 'charge_routed',
+                               'fields': {'vehicle_id': data['vehicle_id'],
+                                          'substation_id': result.get('substation_id')}})
             return jsonify(result), 200
         else:
-            logger.error(f"Load balancer error: {response.status_code}")
+            logger.error("Load balancer error: %s", response.status_code, extra={'event': 'load_balancer_error'})
             return jsonify({'error': 'Failed to route charge request'}), 500
             
     except requests.RequestException as e:
-        logger.error(f"Connection error to load balancer: {str(e)}")
+        logger.error("Connection error to load balancer: %s", e, extra={'event': 'load_balancer_error'})
+        return jsonify({'error': 'Load balancer unavailable'}), 503
+    except Exception as e:
+        logger.error("Unexpected error: %s", e, extra={'event': 'internal_error'})
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/charge_batch', methods=['POST'])
+def charge_batch_request():
+    """
+    Handles a burst of EV charging requests (e.g. from a fleet depot) and forwards
+    them to the load balancer as a single batch
+    """
+    try:
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('requests'), list):
+            return jsonify({'error': 'Expected a list of charge requests under "requests"'}), 400
+        
+        required_fields = ['vehicle_id', 'charge_amount', 'priority']
+        timestamp = datetime.now().isoformat()
+        for index, item in enumerate(data['requests']):
+            for field in required_fields:
+                if field not in item:
+                    return jsonify({'error': f'Request {index}: Missing required field: {field}'}), 400
+            item['timestamp'] = timestamp
+        
+        logger.info("Received batch of %s charge requests", len(data['requests']),
+                    extra={'event': 'charge_batch_received', 'fields': {'batch_size': len(data['requests'])}})
+        
+        response = post_to_load_balancer('/charge_batch', {'requests': data['requests']})
+        
+        if response.status_code == 200:
+            result = response.json()
+            logger.info("Batch routed: %s accepted, %s rejected", result.get('accepted'), result.get('rejected'),
+                        extra={'event': 'charge_batch_routed',
+                               'fields': {'accepted': result.get('accepted'), 'rejected': result.get('rejected')}})
+            return jsonify(result), 200
+        else:
+            logger.error("Load balancer error: %s", response.status_code, extra={'event': 'load_balancer_error'})
+            return jsonify({'error': 'Failed to route charge batch'}), 500
+            
+    except requests.RequestException as e:
+        logger.error("Connection error to load balancer: %s", e, extra={'event': 'load_balancer_error'})
         return jsonify({'error': 'Load balancer unavailable'}), 503
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
+        logger.error("Unexpected error: %s", e, extra={'event': 'internal_error'})
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/health', methods=['GET'])
@@ -59,18 +293,31 @@ def health_check():
 @app.route('/status', methods=['GET'])
 def status():
     """Service status endpoint"""
-    try:
-        response = requests.get(f"{LOAD_BALANCER_URL}/health", timeout=5)
-        lb_status = "healthy" if response.status_code == 200 else "unhealthy"
-    except:
-        lb_status = "unreachable"
+    replica_status = {}
+    for url in LOAD_BALANCER_URLS:
+        try:
+            response = requests.get(f"{url}/health", timeout=5)
+            replica_status[url] = "healthy" if response.status_code == 200 else "unhealthy"
+        except:
+            replica_status[url] = "unreachable"
+    
+    if any(state == "healthy" for state in replica_status.values()):
+        lb_status = "healthy"
+    else:
+        lb_status = "unhealthy" if "unhealthy" in replica_status.values() else "unreachable"
     
     return jsonify({
         'service': 'charge_request_service',
         'status': 'running',
         'load_balancer_status': lb_status,
+        'load_balancer_replicas': replica_status,
+        'fast_path': FAST_PATH,
+        'routing_table_version': routing_table['version'],
+        'routing_table_age': round(time.time() - routing_table['fetched_at'], 3) if routing_table['version'] else None,
         'timestamp': datetime.now().isoformat()
     }), 200
 
 if __name__ == '__main__':
+    if FAST_PATH:
+        threading.Thread(target=refresh_routing_table, daemon=True).start()
     app.run(host='0.0.0.0', port=8000, debug=False)
\ No newline at end of file
@@ -0,0 +1,106 @@
+"""
+Asynchronous, sampled, structured logging shared by the smart grid services.
+
+Request threads only filter and enqueue log records; formatting and writing happen on a
+background listener thread. Callers should pass values as logging arguments and structured
+fields via `extra`, rather than pre-formatting messages with f-strings:
+
+    logger.info("Started charging session %s", session_id,
+                extra={'event': 'charge_started', 'fields': {'charge_amount': 22}})
+
+LOG_SAMPLE_RATES samples INFO/DEBUG records per event, e.g. "charge_started=0.1,charge_completed=0.01".
+Warnings and errors are never sampled.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_QUEUE_SIZE = 10000
+
+def parse_sample_rates(spec):
+    """Parse "event=rate,event=rate" into a dict"""
+    rates = {}
+    for item in spec.split(','):
+        if '=' in item:
+            event, rate = item.split('=', 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of INFO/DEBUG records per event type"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None), 1.0)
+        if rate < 1.0:
+            if random.random() >= rate:
+                return False
+            record.sample_rate = rate
+        return True
+
+class DeferredQueueHandler(QueueHandler):
+    """Enqueue records untouched, leaving all formatting to the listener thread"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        # Never block a request thread on a full queue; count the loss instead
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'service': self.service,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+        }
+        if hasattr(record, 'sample_rate'):
+            entry['sample_rate'] = record.sample_rate
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logging(service):
+    """Route the root logger through a background listener; returns the queue handler"""
+    log_queue = queue.Queue(int(os.getenv('LOG_QUEUE_SIZE', LOG_QUEUE_SIZE)))
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(os.getenv('LOG_SAMPLE_RATES', ''))))
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter(service))
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+    return queue_handler
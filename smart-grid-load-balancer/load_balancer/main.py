@@ -1,14 +1,21 @@
 from flask import Flask, request, jsonify
 import requests
+import hashlib
+import json
 import logging
 import os
 import time
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import re
+from grid_logging import setup_logging
+from replication import SharedLoadState
+from routing import assign_batch, least_loaded, select_by_predicted_headroom, HeadroomForecast
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+log_handler = setup_logging('load_balancer')
 logger = logging.getLogger(__name__)
 
 SUBSTATIONS = [
@@ -16,23 +23,48 @@ SUBSTATIONS = [
     {'id': 'substation_2', 'url': 'http://substation_2:8001'},
     {'id': 'substation_3', 'url': 'http://substation_3:8001'}
 ]
+SUBSTATIONS_BY_ID = {substation['id']: substation for substation in SUBSTATIONS}
 
-substation_loads = {}
+# 'predictive' routes on forecast headroom, 'least_loaded' on the instantaneous load
+ROUTING_POLICY = os.getenv('ROUTING_POLICY', 'predictive')
+
+# Active-active replicas gossip their substation polls and reservations to each other
+REPLICA_ID = os.getenv('REPLICA_ID', 'load_balancer')
+PEER_URLS = [url for url in os.getenv('PEER_URLS', '').split(',') if url]
+GOSSIP_INTERVAL = float(os.getenv('GOSSIP_INTERVAL', '0.5'))
+
+# How long gateways may dispatch directly from a routing table before it counts as stale
+ROUTING_TABLE_TTL = float(os.getenv('ROUTING_TABLE_TTL', '10'))
+
+shared_state = SharedLoadState(REPLICA_ID, [substation['id'] for substation in SUBSTATIONS], epoch=time.time())
+substation_capacities = {}
+substation_forecasts = {}
 for substation in SUBSTATIONS:
-    substation_loads[substation['id']] = 0
+    substation_forecasts[substation['id']] = HeadroomForecast()
+
+# Ids of recently recorded gateway dispatch reports, so a re-sent report is counted once
+recorded_reports = OrderedDict()
+RECORDED_REPORTS_LIMIT = 100000
 
 load_lock = threading.Lock()
 
-def parse_prometheus_metrics(metrics_text):
+def parse_prometheus_metrics(metrics_text, metric_name='substation_current_load'):
     """Parse Prometheus metrics text format"""
-    current_load = 0
+    value = 0
     for line in metrics_text.split('\n'):
-        if line.startswith('substation_current_load'):
-            match = re.search(r'substation_current_load\s+(\d+(?:\.\d+)?)', line)
+        if line.startswith(metric_name):
+            match = re.search(rf'{metric_name}\s+(\d+(?:\.\d+)?)', line)
             if match:
-                current_load = float(match.group(1))
+                value = float(match.group(1))
                 break
-    return current_load
+    return value
+
+def parse_release_schedule(metrics_text):
+    """Parse the substation_release_schedule{bucket="i"} series into a list of buckets"""
+    buckets = {}
+    for match in re.finditer(r'substation_release_schedule\{bucket="(\d+)"\}\s+(\d+(?:\.\d+)?)', metrics_text):
+        buckets[int(match.group(1))] = float(match.group(2))
+    return [buckets[bucket] for bucket in sorted(buckets)]
 
 def update_substation_loads():
     """Periodically update substation loads by polling their metrics"""
@@ -40,39 +72,138 @@ def update_substation_loads():
         try:
             for substation in SUBSTATIONS:
                 try:
+                    polled_at = time.time()
                     response = requests.get(f"{substation['url']}/metrics", timeout=5)
                     if response.status_code == 200:
                         current_load = parse_prometheus_metrics(response.text)
+                        max_capacity = parse_prometheus_metrics(response.text, 'substation_max_capacity')
+                        admitted_total = parse_prometheus_metrics(response.text, 'substation_admitted_total')
+                        base_duration = parse_prometheus_metrics(response.text, 'substation_charge_processing_seconds')
+                        bucket_seconds = parse_prometheus_metrics(response.text, 'substation_release_bucket_seconds')
+                        release = parse_release_schedule(response.text)
                         with load_lock:
-                            substation_loads[substation['id']] = current_load
-                        logger.debug(f"Updated {substation['id']} load: {current_load}")
+                            shared_state.record_poll(substation['id'], current_load, polled_at)
+                            substation_capacities[substation['id']] = max_capacity
+                            substation_forecasts[substation['id']].update(
+                                time.time(), current_load, max_capacity, admitted_total,
+                                release, bucket_seconds, base_duration)
+                        logger.debug("Updated %s load: %s", substation['id'], current_load,
+                                     extra={'event': 'load_polled',
+                                            'fields': {'substation_id': substation['id'], 'load': current_load}})
                     else:
-                        logger.warning(f"Failed to get metrics from {substation['id']}")
+                        logger.warning("Failed to get metrics from %s", substation['id'], extra={'event': 'poll_error'})
                 except requests.RequestException as e:
-                    logger.error(f"Error polling {substation['id']}: {str(e)}")
+                    logger.error("Error polling %s: %s", substation['id'], e, extra={'event': 'poll_error'})
 
 
             time.sleep(5) 
             
         except Exception as e:
-            logger.error(f"Error in load update thread: {str(e)}")
+            logger.error("Error in load update thread: %s", e, extra={'event': 'poll_error'})
             time.sleep(10) 
 
-def get_least_loaded_substation():
-    """Find the substation with the lowest current load"""
+def get_best_substation(charge_amount, priority):
+    """
+    Pick a substation using the configured routing policy and reserve the charge there.
+    Returns the substation, the reservation token, the load seen before reserving and
+    whether that view expected the charge to fit.
+    """
+    now = time.time()
     with load_lock:
-        if not substation_loads:
-            return SUBSTATIONS[0]  
-        min_load = float('inf')
-        best_substation = None
-        
-        for substation in SUBSTATIONS:
-            load = substation_loads.get(substation['id'], 0)
-            if load < min_load:
-                min_load = load
-                best_substation = substation
-        
-        return best_substation if best_substation else SUBSTATIONS[0]
+        loads = shared_state.loads()
+        if ROUTING_POLICY == 'predictive':
+            for substation_id, forecast in substation_forecasts.items():
+                forecast.rebase(loads[substation_id])
+            best_id = select_by_predicted_headroom(substation_forecasts, charge_amount, priority, now)
+        else:
+            best_id = least_loaded([substation['id'] for substation in SUBSTATIONS], loads)
+        token = shared_state.reserve(best_id, charge_amount, now)
+        expected_fit = loads[best_id] + charge_amount <= substation_capacities.get(best_id, 0)
+    
+    return SUBSTATIONS_BY_ID[best_id], token, loads[best_id], expected_fit
+
+def build_routing_table():
+    """
+    Substation URLs, headroom and selection weights for gateways' direct dispatch.
+    The version is a hash of the contents, so replicas publishing the same table agree on it.
+    Must be called with load_lock held.
+    """
+    now = time.time()
+    loads = shared_state.loads()
+    entries = []
+    for substation in SUBSTATIONS:
+        substation_id = substation['id']
+        headroom = substation_capacities.get(substation_id, 0) - loads[substation_id]
+        if ROUTING_POLICY == 'predictive':
+            forecast = substation_forecasts[substation_id]
+            forecast.rebase(loads[substation_id])
+            weight = forecast.predicted_headroom(now, forecast.base_duration)
+        else:
+            weight = headroom
+        entries.append({
+            'id': substation_id,
+            'url': substation['url'],
+            'headroom': round(headroom, 1),
+            'weight': round(max(weight, 0.0))
+        })
+    
+    version = hashlib.sha1(json.dumps(entries, sort_keys=True).encode()).hexdigest()[:16]
+    return version, entries
+
+def settle_reservation(substation_id, token, status_code, expected_fit):
+    """
+    Release the reservation of a charge the substation did not admit and count the outcome.
+    A capacity rejection of a charge our shared view expected to fit is an over-admission.
+    """
+    with load_lock:
+        if status_code != 200:
+            shared_state.cancel(substation_id, token)
+        shared_state.record_result(over_admitted=expected_fit and status_code == 503)
+
+def gossip_with_peers():
+    """Periodically exchange load and reservation state with the other replicas (push-pull)"""
+    session = requests.Session()
+    while True:
+        try:
+            with load_lock:
+                shared_state.expire_peers(time.time())
+                payload = shared_state.snapshot()
+            
+            for peer_url in PEER_URLS:
+                try:
+                    response = session.post(f"{peer_url}/gossip", json=payload, timeout=1)
+                    if response.status_code == 200:
+                        with load_lock:
+                            shared_state.merge(response.json(), time.time())
+                except requests.RequestException as e:
+                    logger.debug("Gossip to %s failed: %s", peer_url, e, extra={'event': 'gossip_error'})
+            
+            time.sleep(GOSSIP_INTERVAL)
+            
+        except Exception as e:
+            logger.error("Error in gossip thread: %s", e, extra={'event': 'gossip_error'})
+            time.sleep(GOSSIP_INTERVAL)
+
+def send_substation_batch(substation, indexed_requests):
+    """Send one batch to a substation and return (index, result) pairs"""
+    try:
+        response = requests.post(
+            f"{substation['url']}/charge_batch",
+            json={'requests': [item for _, item in indexed_requests]},
+            timeout=30
+        )
+        if response.status_code == 200:
+            results = response.json()['results']
+        else:
+            logger.error("Substation %s returned error: %s", substation['id'], response.status_code,
+                         extra={'event': 'substation_error'})
+            results = [{'error': 'Substation processing failed', 'status_code': 500}] * len(indexed_requests)
+    except requests.RequestException as e:
+        logger.error("Connection error to %s: %s", substation['id'], e, extra={'event': 'substation_error'})
+        results = [{'error': 'Substation unavailable', 'status_code': 503}] * len(indexed_requests)
+    
+    return [(index, dict(result, substation_id=substation['id']))
+            for (index, _), result in zip(indexed_requests, results)]
 
 @app.route('/route_charge', methods=['POST'])
 def route_charge():
@@ -83,32 +214,112 @@ def route_charge():
         if not data:
             return jsonify({'error': 'No data provided'}), 400
         
-        best_substation = get_least_loaded_substation()
+        best_substation, token, load_before, expected_fit = get_best_substation(float(data.get('charge_amount', 0)),
+                                                                                data.get('priority', 'normal'))
         
-        logger.info(f"Routing charge request to {best_substation['id']} "
-                   f"(load: {substation_loads.get(best_substation['id'], 0)})")
+        logger.info("Routing charge request to %s (load: %s)", best_substation['id'], load_before,
+                    extra={'event': 'route_charge',
+                           'fields': {'substation_id': best_substation['id'], 'load': load_before}})
         
-        response = requests.post(
-            f"{best_substation['url']}/charge",
-            json=data,
-            timeout=30
-        )
+        try:
+            response = requests.post(
+                f"{best_substation['url']}/charge",
+                json=data,
+                timeout=30
+            )
+        except requests.RequestException:
+            settle_reservation(best_substation['id'], token, 500, expected_fit)
+            raise
+        settle_reservation(best_substation['id'], token, response.status_code, expected_fit)
         
         if response.status_code == 200:
             result = response.json()
             result['routed_by'] = 'load_balancer'
             result['substation_id'] = best_substation['id']
-            result['substation_load_before'] = substation_loads.get(best_substation['id'], 0)
+            result['substation_load_before'] = load_before
             return jsonify(result), 200
         else:
-            logger.error(f"Substation {best_substation['id']} returned error: {response.status_code}")
+            logger.error("Substation %s returned error: %s", best_substation['id'], response.status_code,
+                         extra={'event': 'substation_error'})
             return jsonify({'error': 'Substation processing failed'}), 500
             
     except requests.RequestException as e:
-        logger.error(f"Connection error to substation: {str(e)}")
+        logger.error("Connection error to substation: %s", e, extra={'event': 'substation_error'})
         return jsonify({'error': 'Substation unavailable'}), 503
     except Exception as e:
-        logger.error(f"Unexpected error in load balancer: {str(e)}")
+        logger.error("Unexpected error in load balancer: %s", e, extra={'event': 'internal_error'})
+        return jsonify({'error': 'Load balancer internal error'}), 500
+
+@app.route('/charge_batch', methods=['POST'])
+def route_charge_batch():
+    """Assign a batch of charging requests across substations and send one batch per substation"""
+    try:
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('requests'), list):
+            return jsonify({'error': 'Expected a list of charge requests under "requests"'}), 400
+        
+        charge_requests = data['requests']
+        required_fields = ['vehicle_id', 'charge_amount', 'priority']
+        for index, item in enumerate(charge_requests):
+            for field in required_fields:
+                if field not in item:
+                    return jsonify({'error': f'Request {index}: Missing required field: {field}'}), 400
+            float(item['charge_amount'])
+        
+        # Reserve the assigned capacity up front so that concurrent batches and
+        # single requests see it before the next metrics poll
+        now = time.time()
+        tokens = {}
+        with load_lock:
+            loads = shared_state.loads()
+            headroom = {substation['id']: substation_capacities.get(substation['id'], 0) - loads[substation['id']]
+                        for substation in SUBSTATIONS}
+            assignment = assign_batch(charge_requests, headroom)
+            for index, substation_id in enumerate(assignment):
+                if substation_id:
+                    tokens[index] = shared_state.reserve(substation_id, float(charge_requests[index]['charge_amount']), now)
+        
+        batches = {}
+        for index, substation_id in enumerate(assignment):
+            if substation_id:
+                batches.setdefault(substation_id, []).append((index, charge_requests[index]))
+        
+        batch_sizes = {substation_id: len(items) for substation_id, items in batches.items()}
+        logger.info("Routing batch of %s requests: %s", len(charge_requests), batch_sizes,
+                    extra={'event': 'route_batch', 'fields': {'batch_sizes': batch_sizes}})
+        
+        results = [{'error': 'Insufficient capacity', 'status_code': 503,
+                    'vehicle_id': item.get('vehicle_id')} for item in charge_requests]
+        if batches:
+            with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+                futures = [executor.submit(send_substation_batch, substation, batches[substation['id']])
+                           for substation in SUBSTATIONS if substation['id'] in batches]
+                for future in futures:
+                    for index, result in future.result():
+                        result['routed_by'] = 'load_balancer'
+                        results[index] = result
+                        # Everything sent was assigned because it fit, so any capacity rejection is an over-admission
+                        settle_reservation(result['substation_id'], tokens[index], result['status_code'],
+                                           result.get('error') == 'Insufficient capacity')
+        
+        # Requests that fit nowhere were rejected here without reaching a substation
+        with load_lock:
+            for substation_id in assignment:
+                if not substation_id:
+                    shared_state.record_result()
+        
+        accepted = sum(1 for result in results if result['status_code'] == 200)
+        return jsonify({
+            'results': results,
+            'accepted': accepted,
+            'rejected': len(results) - accepted
+        }), 200
+        
+    except ValueError as e:
+        return jsonify({'error': f'Invalid charge amount: {str(e)}'}), 400
+    except Exception as e:
+        logger.error("Unexpected error in load balancer: %s", e, extra={'event': 'internal_error'})
         return jsonify({'error': 'Load balancer internal error'}), 500
 
 @app.route('/health', methods=['GET'])
@@ -122,22 +333,91 @@ def status():
     with load_lock:
         return jsonify({
             'service': 'load_balancer',
-            'substation_loads': dict(substation_loads),
+            'replica_id': REPLICA_ID,
+            'substation_loads': shared_state.loads(),
+            'peers': sorted(shared_state.peers),
+            'cluster_counters': shared_state.cluster_counters(),
             'timestamp': datetime.now().isoformat()
         }), 200
 
+@app.route('/routing_table', methods=['GET'])
+def get_routing_table():
+    """Publish the routing table; answers 304 when the caller already has this version"""
+    with load_lock:
+        version, entries = build_routing_table()
+    
+    if request.args.get('since') == version:
+        return '', 304
+    return jsonify({
+        'version': version,
+        'replica_id': REPLICA_ID,
+        'ttl': ROUTING_TABLE_TTL,
+        'substations': entries,
+        'timestamp': datetime.now().isoformat()
+    }), 200
+
+@app.route('/dispatch_report', methods=['POST'])
+def dispatch_report():
+    """
+    Record charges a gateway dispatched straight to substations, so they count towards the
+    shared load view and the request and over-admission counters like routed ones
+    """
+    payload = request.get_json()
+    if not payload or not isinstance(payload.get('dispatches'), list):
+        return jsonify({'error': 'Expected a list of dispatches under "dispatches"'}), 400
+    
+    with load_lock:
+        for dispatch in payload['dispatches']:
+            substation_id = dispatch.get('substation_id')
+            if substation_id not in SUBSTATIONS_BY_ID or dispatch.get('id') in recorded_reports:
+                continue
+            if dispatch.get('id') is not None:
+                recorded_reports[dispatch['id']] = None
+                if len(recorded_reports) > RECORDED_REPORTS_LIMIT:
+                    recorded_reports.popitem(last=False)
+            if dispatch.get('status_code') == 200:
+                # Dropped by the next poll taken after the dispatch, which includes the session
+                shared_state.reserve(substation_id, float(dispatch['charge_amount']), float(dispatch['dispatched_at']))
+            # Gateways only dispatch charges the published headroom expected to fit
+            shared_state.record_result(over_admitted=dispatch.get('status_code') == 503)
+    
+    return jsonify({'recorded': len(payload['dispatches'])}), 200
+
+@app.route('/gossip', methods=['POST'])
+def gossip():
+    """Merge a peer replica's state and reply with our own"""
+    payload = request.get_json()
+    if not payload or 'replica_id' not in payload:
+        return jsonify({'error': 'Invalid gossip payload'}), 400
+    
+    with load_lock:
+        shared_state.merge(payload, time.time())
+        return jsonify(shared_state.snapshot()), 200
+
 @app.route('/metrics', methods=['GET'])
 def metrics():
     """Expose load balancer metrics in Prometheus format"""
     with load_lock:
         metrics_text = "# HELP load_balancer_requests_total Total requests processed by load balancer\n"
         metrics_text += "# TYPE load_balancer_requests_total counter\n"
-        metrics_text += "load_balancer_requests_total 1\n"
+        metrics_text += f"load_balancer_requests_total {shared_state.counters['requests']}\n"
         
-        for substation_id, load in substation_loads.items():
+        metrics_text += "# HELP load_balancer_over_admissions_total Routed requests the substation rejected for lack of capacity\n"
+        metrics_text += "# TYPE load_balancer_over_admissions_total counter\n"
+        metrics_text += f"load_balancer_over_admissions_total {shared_state.counters['over_admissions']}\n"
+        
+        metrics_text += "# HELP load_balancer_peers Peer replicas currently exchanging state\n"
+        metrics_text += "# TYPE load_balancer_peers gauge\n"
+        metrics_text += f"load_balancer_peers {len(shared_state.peers)}\n"
+        
+        for substation_id, load in shared_state.loads().items():
             metrics_text += f"# HELP substation_load Current load of substation {substation_id}\n"
             metrics_text += f"# TYPE substation_load gauge\n"
             metrics_text += f'substation_load{{substation_id="{substation_id}"}} {load}\n'
+        
+        metrics_text += "# HELP log_records_dropped_total Log records dropped because the log queue was full\n"
+        metrics_text += "# TYPE log_records_dropped_total counter\n"
+        metrics_text += f"log_records_dropped_total {log_handler.dropped}\n"
     
     return metrics_text, 200, {'Content-Type': 'text/plain'}
 
@@ -145,5 +425,9 @@ if __name__ == '__main__':
     load_thread = threading.Thread(target=update_substation_loads, daemon=True)
     load_thread.start()
     
-    logger.info("Starting load balancer service...")
+    if PEER_URLS:
+        gossip_thread = threading.Thread(target=gossip_with_peers, daemon=True)
+        gossip_thread.start()
+    
+    logger.info("Starting load balancer service %s (peers: %s)", REPLICA_ID, PEER_URLS, extra={'event': 'startup'})
     app.run(host='0.0.0.0', port=8080, debug=False)
\ No newline at end of file
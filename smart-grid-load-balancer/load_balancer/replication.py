@@ -0,0 +1,131 @@
+"""Substation load and reservation state shared between active-active load balancer replicas"""
+
+class SharedLoadState:
+    """
+    Per-substation load view merged from every replica.
+
+    Each replica polls the substations itself and records the capacity it routes as
+    timestamped reservations. Replicas gossip their latest polls and their own reservations;
+    the effective load of a substation is the freshest poll from any replica plus every
+    replica's reservations made after that poll, which the poll cannot have seen yet.
+    Not thread-safe: callers hold the load balancer's load_lock.
+    """
+
+    def __init__(self, replica_id, substation_ids, epoch=0.0, peer_ttl=10.0):
+        self.replica_id = replica_id
+        self.peer_ttl = peer_ttl
+        # A restarted replica gets a new epoch, so its reset version is not mistaken for stale gossip
+        self.epoch = epoch
+        self.version = 0
+        # substation id -> (load, polled_at)
+        self.polls = {substation_id: (0.0, 0.0) for substation_id in substation_ids}
+        # replica id -> substation id -> [(reserved_at, amount)]
+        self.reservations = {replica_id: {substation_id: [] for substation_id in substation_ids}}
+        # replica id -> ((epoch, version), received_at, counters)
+        self.peers = {}
+        self.counters = {'requests': 0, 'over_admissions': 0}
+        # substation id -> reservations not yet covered by its poll, or None when stale
+        self.reserved_totals = None
+
+    def record_poll(self, substation_id, load, polled_at):
+        if polled_at >= self.polls[substation_id][1]:
+            self.polls[substation_id] = (load, polled_at)
+            self._prune(substation_id)
+            self.reserved_totals = None
+
+    def reserve(self, substation_id, amount, now):
+        """Record capacity routed to a substation; returns a token for cancel()"""
+        token = (now, amount)
+        self.reservations[self.replica_id][substation_id].append(token)
+        self._adjust_total(substation_id, token, amount)
+        self.version += 1
+        return token
+
+    def cancel(self, substation_id, token):
+        """Drop a reservation whose charge the substation did not admit"""
+        own = self.reservations[self.replica_id][substation_id]
+        if token in own:
+            own.remove(token)
+            self._adjust_total(substation_id, token, -token[1])
+            self.version += 1
+
+    def record_result(self, over_admitted=False):
+        """Count a routed request, and whether the substation rejected it for lack of capacity"""
+        self.counters['requests'] += 1
+        if over_admitted:
+            self.counters['over_admissions'] += 1
+        self.version += 1
+
+    def effective_load(self, substation_id):
+        if self.reserved_totals is None:
+            self.reserved_totals = {}
+            for sid, (_, polled_at) in self.polls.items():
+                self.reserved_totals[sid] = sum(
+                    amount
+                    for by_substation in self.reservations.values()
+                    for reserved_at, amount in by_substation.get(sid, ())
+                    if reserved_at > polled_at)
+        return self.polls[substation_id][0] + self.reserved_totals[substation_id]
+
+    def loads(self):
+        return {substation_id: self.effective_load(substation_id) for substation_id in self.polls}
+
+    def snapshot(self):
+        """Gossip payload: our polls, our own outstanding reservations and counters"""
+        return {
+            'replica_id': self.replica_id,
+            'epoch': self.epoch,
+            'version': self.version,
+            'polls': {substation_id: list(poll) for substation_id, poll in self.polls.items()},
+            'reservations': {substation_id: [list(token) for token in tokens]
+                             for substation_id, tokens in self.reservations[self.replica_id].items()},
+            'counters': dict(self.counters),
+        }
+
+    def merge(self, payload, now):
+        """Fold in a peer's gossip payload; stale or duplicate versions are ignored"""
+        replica_id = payload['replica_id']
+        if replica_id == self.replica_id:
+            return
+        version = (payload.get('epoch', 0.0), payload['version'])
+        known = self.peers.get(replica_id)
+        if known and version <= known[0]:
+            self.peers[replica_id] = (known[0], now, known[2])
+            return
+
+        self.peers[replica_id] = (version, now, payload.get('counters', {}))
+        self.reserved_totals = None
+        self.reservations[replica_id] = {
+            substation_id: [tuple(token) for token in tokens]
+            for substation_id, tokens in payload.get('reservations', {}).items()
+        }
+        for substation_id, (load, polled_at) in payload.get('polls', {}).items():
+            if substation_id in self.polls:
+                self.record_poll(substation_id, load, polled_at)
+
+    def expire_peers(self, now):
+        """Forget replicas we have not heard from within peer_ttl"""
+        for replica_id, (_, received_at, _) in list(self.peers.items()):
+            if now - received_at > self.peer_ttl:
+                del self.peers[replica_id]
+                self.reservations.pop(replica_id, None)
+                self.reserved_totals = None
+
+    def cluster_counters(self):
+        totals = dict(self.counters)
+        for _, _, counters in self.peers.values():
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def _adjust_total(self, substation_id, token, delta):
+        if self.reserved_totals is not None and token[0] > self.polls[substation_id][1]:
+            self.reserved_totals[substation_id] += delta
+
+    def _prune(self, substation_id):
+        polled_at = self.polls[substation_id][1]
+        own = self.reservations[self.replica_id][substation_id]
+        live = [token for token in own if token[0] > polled_at]
+        if len(live) != len(own):
+            self.reservations[self.replica_id][substation_id] = live
+            self.version += 1
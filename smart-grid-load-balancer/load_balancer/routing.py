@@ -0,0 +1,132 @@
+"""Substation selection policies used by the load balancer and the offline replay"""
+
+PRIORITY_RANK = {'high': 0, 'normal': 1, 'low': 2}
+
+ARRIVAL_RATE_ALPHA = 0.3
+
+def least_loaded(substation_ids, loads):
+    """Pick the substation with the lowest current load (first one wins ties)"""
+    best_substation = None
+    min_load = float('inf')
+    for substation_id in substation_ids:
+        load = loads.get(substation_id, 0)
+        if load < min_load:
+            min_load = load
+            best_substation = substation_id
+    return best_substation
+
+def assign_batch(charge_requests, headroom):
+    """
+    Assign charge requests to substations with priority-aware first-fit-decreasing.
+    Requests are ordered by priority, then by charge amount (largest first), and each
+    is placed in the first substation, ordered by headroom, that can still fit it.
+    Returns a list of substation ids (None when nothing fits) in the input order.
+    """
+    remaining = dict(headroom)
+    bins = sorted(remaining, key=lambda substation_id: remaining[substation_id], reverse=True)
+    order = sorted(range(len(charge_requests)),
+                   key=lambda i: (PRIORITY_RANK.get(charge_requests[i].get('priority'), 1),
+                                  -float(charge_requests[i]['charge_amount'])))
+
+    assignment = [None] * len(charge_requests)
+    for i in order:
+        charge_amount = float(charge_requests[i]['charge_amount'])
+        for substation_id in bins:
+            if remaining[substation_id] >= charge_amount:
+                remaining[substation_id] -= charge_amount
+                assignment[i] = substation_id
+                break
+
+    return assignment
+
+def expected_duration(base_duration, priority):
+    """Mean session duration, mirroring the substation's duration rule"""
+    if priority == 'high':
+        return max(base_duration * 0.7, 5)
+    elif priority == 'low':
+        return base_duration * 1.3
+    return base_duration
+
+class HeadroomForecast:
+    """
+    Short-term load forecast for one substation.
+    Combines the last polled load, the substation's release schedule (capacity freed per
+    future bucket) and an EWMA of the admitted charge rate to predict future headroom.
+    """
+
+    def __init__(self, alpha=ARRIVAL_RATE_ALPHA):
+        self.alpha = alpha
+        self.current_load = 0.0
+        self.max_capacity = 0.0
+        self.base_duration = 0.0
+        self.release = []
+        self.cumulative_release = [0.0]
+        self.bucket_seconds = 1.0
+        self.arrival_rate = 0.0
+        self.admitted_total = None
+        self.updated_at = None
+
+    def update(self, now, current_load, max_capacity, admitted_total, release, bucket_seconds, base_duration):
+        """Fold in a fresh metrics snapshot taken at `now` (seconds)"""
+        if self.admitted_total is not None and now > self.updated_at and admitted_total >= self.admitted_total:
+            rate = (admitted_total - self.admitted_total) / (now - self.updated_at)
+            self.arrival_rate = self.alpha * rate + (1 - self.alpha) * self.arrival_rate
+        self.current_load = current_load
+        self.max_capacity = max_capacity
+        self.admitted_total = admitted_total
+        self.release = list(release)
+        # cumulative_release[i] is the capacity freed by the start of bucket i
+        self.cumulative_release = [0.0]
+        for amount in self.release:
+            self.cumulative_release.append(self.cumulative_release[-1] + amount)
+        self.bucket_seconds = bucket_seconds or 1.0
+        self.base_duration = base_duration
+        self.updated_at = now
+
+    def rebase(self, current_load):
+        """Replace the snapshot load with a fresher estimate, e.g. one including peer replicas' reservations"""
+        self.current_load = current_load
+
+    def released_by(self, t):
+        """Capacity released between the snapshot and `t` seconds after it"""
+        if t <= 0:
+            return 0.0
+        bucket = int(t / self.bucket_seconds)
+        if bucket >= len(self.release):
+            return self.cumulative_release[-1]
+        fraction = t / self.bucket_seconds - bucket
+        return self.cumulative_release[bucket] + self.release[bucket] * fraction
+
+    def headroom_at(self, t, elapsed=0.0):
+        """
+        Predicted headroom `t` seconds after the snapshot, `elapsed` seconds of which have
+        passed. Arrivals up to now are already in current_load, so the arrival rate only
+        applies to the time after it.
+        """
+        load = self.current_load - self.released_by(t) + self.arrival_rate * max(t - elapsed, 0.0)
+        return self.max_capacity - max(load, 0.0)
+
+    def predicted_headroom(self, now, duration):
+        """Mean predicted headroom over [now, now + duration]"""
+        elapsed = max(now - self.updated_at, 0.0) if self.updated_at is not None else 0.0
+        steps = max(int(duration / self.bucket_seconds), 1)
+        step = duration / steps
+        return sum(self.headroom_at(elapsed + (i + 0.5) * step, elapsed) for i in range(steps)) / steps
+
+def select_by_predicted_headroom(forecasts, charge_amount, priority, now):
+    """
+    Pick the substation with the most predicted headroom over the new session's expected
+    duration, among those whose headroom right now can fit the request. Falls back to the
+    best predicted headroom when none of them can.
+    """
+    best_substation = None
+    best_key = None
+    for substation_id, forecast in forecasts.items():
+        elapsed = max(now - forecast.updated_at, 0.0) if forecast.updated_at is not None else 0.0
+        fits_now = forecast.headroom_at(elapsed, elapsed) >= charge_amount
+        duration = expected_duration(forecast.base_duration, priority)
+        key = (fits_now, forecast.predicted_headroom(now, duration))
+        if best_key is None or key > best_key:
+            best_key = key
+            best_substation = substation_id
+    return best_substation
@@ -0,0 +1,129 @@
+"""
+Offline replay of a charging trace against the substations' admission rules, comparing
+the rejection rate of the balancer's routing policies without running any containers.
+Both policies see the same load view as the live balancer: the last poll plus the charges
+routed since, with rejected charges cancelled (replication.SharedLoadState).
+
+Usage: python replay.py [arrival_rate ...]
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'substation_service'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'load_balancer'))
+
+from charging import has_capacity, charge_duration, release_schedule, RELEASE_BUCKET_SECONDS
+from replication import SharedLoadState
+from routing import least_loaded, select_by_predicted_headroom, HeadroomForecast
+
+# Mirrors docker-compose.yml: (substation id, MAX_CAPACITY, CHARGE_PROCESSING_TIME)
+SUBSTATION_CONFIG = [
+    ('substation_1', 80, 8),
+    ('substation_2', 120, 10),
+    ('substation_3', 100, 12),
+]
+CHARGE_AMOUNTS = [7, 11, 22, 50, 100, 150]
+PRIORITY_CHOICES = ['low', 'normal', 'normal', 'normal', 'high']
+POLL_INTERVAL = 5
+COMPLETION_INTERVAL = 2
+TRACE_DURATION = 3600
+SEEDS = [1, 2, 3, 4, 5]
+DEFAULT_ARRIVAL_RATES = [1.0, 2.0, 4.0]
+# 'releases_only' is the predictive policy without the arrival-rate EWMA
+POLICIES = ['least_loaded', 'predictive', 'releases_only']
+
+def generate_trace(arrival_rate, duration, seed):
+    """Poisson arrivals with the same request mix as the rush hour load test"""
+    rng = random.Random(seed)
+    trace = []
+    t = rng.expovariate(arrival_rate)
+    while t < duration:
+        trace.append((t, rng.choice(CHARGE_AMOUNTS), rng.choice(PRIORITY_CHOICES), rng.random()))
+        t += rng.expovariate(arrival_rate)
+    return trace
+
+class ReplaySubstation:
+    """In-memory substation applying the same admission and duration rules as the service"""
+
+    def __init__(self, substation_id, max_capacity, processing_time):
+        self.id = substation_id
+        self.max_capacity = max_capacity
+        self.processing_time = processing_time
+        self.current_load = 0
+        self.admitted_total = 0
+        self.sessions = []
+
+    def charge(self, now, charge_amount, priority, jitter):
+        if not has_capacity(self.current_load, charge_amount, self.max_capacity):
+            return False
+        self.current_load += charge_amount
+        self.admitted_total += charge_amount
+        self.sessions.append((now + charge_duration(self.processing_time, priority, jitter), charge_amount))
+        return True
+
+    def complete(self, now):
+        remaining = []
+        for end_time, charge_amount in self.sessions:
+            if now >= end_time:
+                self.current_load -= charge_amount
+            else:
+                remaining.append((end_time, charge_amount))
+        self.sessions = remaining
+        self.current_load = max(self.current_load, 0)
+
+def replay(trace, policy):
+    """Replay a trace through one routing policy and return the rejection rate"""
+    substations = {substation_id: ReplaySubstation(substation_id, capacity, processing_time)
+                   for substation_id, capacity, processing_time in SUBSTATION_CONFIG}
+    view = SharedLoadState('replay', list(substations))
+    forecasts = {substation_id: HeadroomForecast(alpha=0.0) if policy == 'releases_only' else HeadroomForecast()
+                 for substation_id in substations}
+    next_completion = COMPLETION_INTERVAL
+    next_poll = 0.0
+    rejected = 0
+
+    for arrival_time, charge_amount, priority, jitter in trace:
+        while min(next_completion, next_poll) <= arrival_time:
+            if next_completion <= next_poll:
+                for substation in substations.values():
+                    substation.complete(next_completion)
+                next_completion += COMPLETION_INTERVAL
+            else:
+                for substation in substations.values():
+                    view.record_poll(substation.id, substation.current_load, next_poll)
+                    schedule = release_schedule((end_time - next_poll, amount) for end_time, amount in substation.sessions)
+                    forecasts[substation.id].update(next_poll, substation.current_load, substation.max_capacity,
+                                                    substation.admitted_total, schedule, RELEASE_BUCKET_SECONDS,
+                                                    substation.processing_time)
+                next_poll += POLL_INTERVAL
+
+        loads = view.loads()
+        if policy == 'least_loaded':
+            substation_id = least_loaded(list(substations), loads)
+        else:
+            for forecast_id, forecast in forecasts.items():
+                forecast.rebase(loads[forecast_id])
+            substation_id = select_by_predicted_headroom(forecasts, charge_amount, priority, arrival_time)
+        token = view.reserve(substation_id, charge_amount, arrival_time)
+
+        if not substations[substation_id].charge(arrival_time, charge_amount, priority, jitter):
+            view.cancel(substation_id, token)
+            rejected += 1
+
+    return rejected / len(trace) if trace else 0.0
+
+def main():
+    arrival_rates = [float(arg) for arg in sys.argv[1:]] or DEFAULT_ARRIVAL_RATES
+    print(f"{'arrivals/s':>10}" + ''.join(f"  {policy:>13}" for policy in POLICIES))
+    for arrival_rate in arrival_rates:
+        rates = {policy: [] for policy in POLICIES}
+        for seed in SEEDS:
+            trace = generate_trace(arrival_rate, TRACE_DURATION, seed)
+            for policy in rates:
+                rates[policy].append(replay(trace, policy))
+        print(f"{arrival_rate:>10.2f}" + ''.join(f"  {sum(rates[policy]) / len(SEEDS) * 100:>12.1f}%"
+                                                  for policy in POLICIES))
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,12 @@ from datetime import datetime, timedelta
 import sys
 
 CHARGE_REQUEST_URL = "http://localhost:8000/charge"
+CHARGE_BATCH_URL = "http://localhost:8000/charge_batch"
 LOAD_BALANCER_URL = "http://localhost:8080/status"
 TOTAL_REQUESTS = 100
 CONCURRENT_THREADS = 10
 RUSH_HOUR_DURATION = 60  
+BATCH_SIZE = 20
 
 stats = {
     'total_requests': 0,
@@ -150,6 +152,19 @@ def print_final_statistics():
         print(f"Average: {avg_response_time:.3f}s")
         print(f"Minimum: {min_response_time:.3f}s")
         print(f"Maximum: {max_response_time:.3f}s")
+        
+        sorted_times = sorted(stats['response_times'])
+        for percentile in (50, 95, 99):
+            index = min(int(len(sorted_times) * percentile / 100), len(sorted_times) - 1)
+            print(f"p{percentile}: {sorted_times[index]:.3f}s")
+    
+    try:
+        counters = requests.get(LOAD_BALANCER_URL, timeout=5).json().get('cluster_counters', {})
+        if counters.get('requests'):
+            print(f"\nOver-admissions (all balancer replicas): {counters['over_admissions']} of "
+                  f"{counters['requests']} routed or dispatched by the gateway ({counters['over_admissions']/counters['requests']*100:.1f}%)")
+    except Exception as e:
+        print(f"\nCould not fetch load balancer counters: {str(e)}")
     
     print("\n" + "="*80)
 
@@ -200,8 +215,33 @@ def run_simple_test():
         
         time.sleep(2)
 
+def run_batch_test():
+    """Send depot-style bursts of charge requests through the batch endpoint"""
+    print(f"🚚 Running batch test ({BATCH_SIZE} vehicles per burst)...")
+    
+    for i in range(5):
+        batch = [generate_charging_request() for _ in range(BATCH_SIZE)]
+        start_time = time.time()
+        
+        try:
+            response = requests.post(CHARGE_BATCH_URL, json={'requests': batch}, timeout=30)
+            response_time = time.time() - start_time
+            if response.status_code == 200:
+                result = response.json()
+                log_with_timestamp(f"✓ Burst {i+1}/5: {result['accepted']} accepted, "
+                                 f"{result['rejected']} rejected ({response_time:.2f}s, "
+                                 f"{response_time / BATCH_SIZE * 1000:.1f}ms per vehicle)")
+            else:
+                log_with_timestamp(f"⚠ HTTP {response.status_code}: {response.text}")
+        except Exception as e:
+            log_with_timestamp(f"✗ Error: {str(e)}")
+        
+        time.sleep(2)
+
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "simple":
         run_simple_test()
+    elif len(sys.argv) > 1 and sys.argv[1] == "batch":
+        run_batch_test()
     else:
         simulate_rush_hour()
\ No newline at end of file
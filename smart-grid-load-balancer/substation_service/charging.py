@@ -0,0 +1,37 @@
+"""Admission and charging-duration rules shared by the substation service and offline tools"""
+import math
+
+RELEASE_BUCKET_SECONDS = 2
+RELEASE_BUCKET_COUNT = 15
+
+def has_capacity(current_load, charge_amount, max_capacity):
+    """Check whether a new session fits within the substation capacity"""
+    return current_load + charge_amount <= max_capacity
+
+def charge_duration(base_duration, priority, jitter):
+    """
+    Charging duration in seconds for a session of the given priority.
+    `jitter` is a uniform sample in [0, 1) that spreads the duration by +/-20%.
+    """
+    if priority == 'high':
+        duration = max(base_duration * 0.7, 5)
+    elif priority == 'low':
+        duration = base_duration * 1.3
+    else:
+        duration = base_duration
+
+    return duration * (0.8 + jitter * 0.4)
+
+def release_schedule(sessions, bucket_seconds=RELEASE_BUCKET_SECONDS, bucket_count=RELEASE_BUCKET_COUNT):
+    """
+    Capacity freed per future time bucket.
+    `sessions` yields (seconds_until_end, charge_amount) pairs. Bucket i covers
+    [i * bucket_seconds, (i + 1) * bucket_seconds) from now; sessions ending beyond
+    the horizon are left out, since they free nothing within it.
+    """
+    buckets = [0.0] * bucket_count
+    for seconds_until_end, charge_amount in sessions:
+        index = max(int(math.floor(seconds_until_end / bucket_seconds)), 0)
+        if index < bucket_count:
+            buckets[index] += charge_amount
+    return buckets
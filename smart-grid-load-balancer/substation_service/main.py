@@ -1,13 +1,16 @@
 from flask import Flask, request, jsonify
+import itertools
 import logging
 import os
 import time
 import threading
 import random
 from datetime import datetime, timedelta
+from charging import has_capacity, charge_duration, release_schedule, RELEASE_BUCKET_SECONDS
+from grid_logging import setup_logging
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+log_handler = setup_logging('substation')
 logger = logging.getLogger(__name__)
 
 SUBSTATION_ID = os.getenv('SUBSTATION_ID', 'substation_unknown')
@@ -15,7 +18,10 @@ MAX_CAPACITY = int(os.getenv('MAX_CAPACITY', '100'))
 CHARGE_PROCESSING_TIME = int(os.getenv('CHARGE_PROCESSING_TIME', '10'))  
 
 current_load = 0
+admitted_total = 0
 charging_sessions = {} 
+# Keeps session ids unique when a batch admits the same vehicle twice within a second
+session_counter = itertools.count(1)
 load_lock = threading.Lock()
 
 def simulate_charging_completion():
@@ -30,101 +36,172 @@ def simulate_charging_completion():
             with load_lock:
                 for session_id, session_data in charging_sessions.items():
                     if current_time >= session_data['end_time']:
-                        completed_sessions.append(session_id)
+                        completed_sessions.append((session_id, session_data['charge_amount']))
                         current_load -= session_data['charge_amount']
-                        logger.info(f"Charging completed for session {session_id}, "
-                                  f"load reduced by {session_data['charge_amount']}")
                 
                 # Remove completed sessions
-                for session_id in completed_sessions:
+                for session_id, _ in completed_sessions:
                     del charging_sessions[session_id]
                 
                 # Ensure load doesn't go negative
                 if current_load < 0:
                     current_load = 0
             
+            # Log outside the lock so request threads never wait on it
+            for session_id, charge_amount in completed_sessions:
+                logger.info("Charging completed for session %s, load reduced by %s", session_id, charge_amount,
+                            extra={'event': 'charge_completed',
+                                   'fields': {'session_id': session_id, 'charge_amount': charge_amount}})
+            
             time.sleep(2)  # Check every 2 seconds
             
         except Exception as e:
-            logger.error(f"Error in charging completion thread: {str(e)}")
+            logger.error("Error in charging completion thread: %s", e, extra={'event': 'completion_error'})
             time.sleep(5)
 
+def validate_charge_request(data):
+    """Return an error message if a charge request is malformed, otherwise None"""
+    if not data:
+        return 'No data provided'
+    
+    required_fields = ['vehicle_id', 'charge_amount', 'priority']
+    for field in required_fields:
+        if field not in data:
+            return f'Missing required field: {field}'
+    
+    return None
+
+def start_charging_session(vehicle_id, charge_amount, priority):
+    """
+    Admit a charging session if capacity allows. Must be called with load_lock held.
+    Returns the response body and HTTP status code; callers log it via log_charge_result
+    once the lock is released.
+    """
+    global current_load, admitted_total, charging_sessions
+    
+    if not has_capacity(current_load, charge_amount, MAX_CAPACITY):
+        return {
+            'error': 'Insufficient capacity',
+            'vehicle_id': vehicle_id,
+            'current_load': current_load,
+            'max_capacity': MAX_CAPACITY,
+            'available_capacity': MAX_CAPACITY - current_load
+        }, 503
+    
+    session_id = f"{SUBSTATION_ID}_{vehicle_id}_{int(time.time())}_{next(session_counter)}"
+    
+    duration = charge_duration(CHARGE_PROCESSING_TIME, priority, random.random())
+    
+    start_time = datetime.now()
+    end_time = start_time + timedelta(seconds=duration)
+    
+    current_load += charge_amount
+    admitted_total += charge_amount
+    charging_sessions[session_id] = {
+        'vehicle_id': vehicle_id,
+        'charge_amount': charge_amount,
+        'priority': priority,
+        'start_time': start_time,
+        'end_time': end_time,
+        'duration': duration
+    }
+    
+    return {
+        'status': 'accepted',
+        'session_id': session_id,
+        'substation_id': SUBSTATION_ID,
+        'vehicle_id': vehicle_id,
+        'charge_amount': charge_amount,
+        'estimated_duration': duration,
+        'start_time': start_time.isoformat(),
+        'current_load': current_load,
+        'max_capacity': MAX_CAPACITY
+    }, 200
+
+def log_charge_result(result, status_code, charge_amount):
+    """Log the outcome of start_charging_session; must not be called with load_lock held"""
+    if status_code == 200:
+        logger.info("Started charging session %s for vehicle %s, amount: %s, duration: %.1fs, new load: %s",
+                    result['session_id'], result['vehicle_id'], charge_amount,
+                    result['estimated_duration'], result['current_load'],
+                    extra={'event': 'charge_started',
+                           'fields': {'session_id': result['session_id'], 'vehicle_id': result['vehicle_id'],
+                                      'charge_amount': charge_amount, 'duration': result['estimated_duration'],
+                                      'current_load': result['current_load']}})
+    else:
+        logger.warning("Charge request rejected - would exceed capacity (current: %s, requested: %s, max: %s)",
+                       result['current_load'], charge_amount, MAX_CAPACITY,
+                       extra={'event': 'charge_rejected',
+                              'fields': {'vehicle_id': result['vehicle_id'], 'charge_amount': charge_amount,
+                                         'current_load': result['current_load']}})
+
 @app.route('/charge', methods=['POST'])
 def process_charge():
     """Process a charging request"""
-    global current_load, charging_sessions
-    
     try:
         data = request.get_json()
         
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-        
-        required_fields = ['vehicle_id', 'charge_amount', 'priority']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
+        error = validate_charge_request(data)
+        if error:
+            return jsonify({'error': error}), 400
         
         charge_amount = float(data['charge_amount'])
         vehicle_id = data['vehicle_id']
         priority = data.get('priority', 'normal')
         
         with load_lock:
-            if current_load + charge_amount > MAX_CAPACITY:
-                logger.warning(f"Charge request rejected - would exceed capacity "
-                             f"(current: {current_load}, requested: {charge_amount}, max: {MAX_CAPACITY})")
-                return jsonify({
-                    'error': 'Insufficient capacity',
-                    'current_load': current_load,
-                    'max_capacity': MAX_CAPACITY,
-                    'available_capacity': MAX_CAPACITY - current_load
-                }), 503
-            
-            session_id = f"{SUBSTATION_ID}_{vehicle_id}_{int(time.time())}"
-            
-            base_duration = CHARGE_PROCESSING_TIME
-            if priority == 'high':
-                duration = max(base_duration * 0.7, 5)  
-            elif priority == 'low':
-                duration = base_duration * 1.3  
-            else:
-                duration = base_duration
-            
-            duration = duration * (0.8 + random.random() * 0.4)  
-            
-            start_time = datetime.now()
-            end_time = start_time + timedelta(seconds=duration)
-            
-            current_load += charge_amount
-            charging_sessions[session_id] = {
-                'vehicle_id': vehicle_id,
-                'charge_amount': charge_amount,
-                'priority': priority,
-                'start_time': start_time,
-                'end_time': end_time,
-                'duration': duration
-            }
-            
-            logger.info(f"Started charging session {session_id} for vehicle {vehicle_id}, "
-                       f"amount: {charge_amount}, duration: {duration:.1f}s, "
-                       f"new load: {current_load}")
+            result, status_code = start_charging_session(vehicle_id, charge_amount, priority)
+        
+        log_charge_result(result, status_code, charge_amount)
+        return jsonify(result), status_code
+        
+    except ValueError as e:
+        return jsonify({'error': f'Invalid charge amount: {str(e)}'}), 400
+    except Exception as e:
+        logger.error("Unexpected error in charge processing: %s", e, extra={'event': 'charge_error'})
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/charge_batch', methods=['POST'])
+def process_charge_batch():
+    """
+    Process a batch of charging requests under a single lock acquisition.
+    Each request is admitted or rejected individually; results keep the input order.
+    """
+    try:
+        data = request.get_json()
         
+        if not data or not isinstance(data.get('requests'), list):
+            return jsonify({'error': 'Expected a list of charge requests under "requests"'}), 400
+        
+        batch = []
+        for index, item in enumerate(data['requests']):
+            error = validate_charge_request(item)
+            if error:
+                return jsonify({'error': f'Request {index}: {error}'}), 400
+            batch.append((item['vehicle_id'], float(item['charge_amount']), item.get('priority', 'normal')))
+        
+        results = []
+        with load_lock:
+            for vehicle_id, charge_amount, priority in batch:
+                result, status_code = start_charging_session(vehicle_id, charge_amount, priority)
+                result['status_code'] = status_code
+                results.append(result)
+        
+        for result, (_, charge_amount, _) in zip(results, batch):
+            log_charge_result(result, result['status_code'], charge_amount)
+        
+        accepted = sum(1 for result in results if result['status_code'] == 200)
         return jsonify({
-            'status': 'accepted',
-            'session_id': session_id,
             'substation_id': SUBSTATION_ID,
-            'vehicle_id': vehicle_id,
-            'charge_amount': charge_amount,
-            'estimated_duration': duration,
-            'start_time': start_time.isoformat(),
-            'current_load': current_load,
-            'max_capacity': MAX_CAPACITY
+            'results': results,
+            'accepted': accepted,
+            'rejected': len(results) - accepted
         }), 200
         
     except ValueError as e:
         return jsonify({'error': f'Invalid charge amount: {str(e)}'}), 400
     except Exception as e:
-        logger.error(f"Unexpected error in charge processing: {str(e)}")
+        logger.error("Unexpected error in batch charge processing: %s", e, extra={'event': 'charge_error'})
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/metrics', methods=['GET'])
@@ -147,6 +224,29 @@ def metrics():
         metrics_text += f"# HELP substation_utilization_percent Capacity utilization percentage\n"
         metrics_text += f"# TYPE substation_utilization_percent gauge\n"
         metrics_text += f"substation_utilization_percent {utilization:.2f}\n"
+        
+        metrics_text += f"# HELP substation_admitted_total Total charge amount admitted since startup\n"
+        metrics_text += f"# TYPE substation_admitted_total counter\n"
+        metrics_text += f"substation_admitted_total {admitted_total}\n"
+        
+        metrics_text += f"# HELP substation_charge_processing_seconds Base charging session duration\n"
+        metrics_text += f"# TYPE substation_charge_processing_seconds gauge\n"
+        metrics_text += f"substation_charge_processing_seconds {CHARGE_PROCESSING_TIME}\n"
+        
+        now = datetime.now()
+        schedule = release_schedule(((session['end_time'] - now).total_seconds(), session['charge_amount'])
+                                    for session in charging_sessions.values())
+        metrics_text += f"# HELP substation_release_bucket_seconds Width of each release schedule bucket\n"
+        metrics_text += f"# TYPE substation_release_bucket_seconds gauge\n"
+        metrics_text += f"substation_release_bucket_seconds {RELEASE_BUCKET_SECONDS}\n"
+        metrics_text += f"# HELP substation_release_schedule Capacity freed by sessions ending in each future bucket\n"
+        metrics_text += f"# TYPE substation_release_schedule gauge\n"
+        for bucket, released in enumerate(schedule):
+            metrics_text += f'substation_release_schedule{{bucket="{bucket}"}} {released}\n'
+        
+        metrics_text += f"# HELP log_records_dropped_total Log records dropped because the log queue was full\n"
+        metrics_text += f"# TYPE log_records_dropped_total counter\n"
+        metrics_text += f"log_records_dropped_total {log_handler.dropped}\n"
     
     return metrics_text, 200, {'Content-Type': 'text/plain'}
 
@@ -180,5 +280,5 @@ if __name__ == '__main__':
     completion_thread = threading.Thread(target=simulate_charging_completion, daemon=True)
     completion_thread.start()
     
-    logger.info(f"Starting substation {SUBSTATION_ID} with capacity {MAX_CAPACITY}")
+    logger.info("Starting substation %s with capacity %s", SUBSTATION_ID, MAX_CAPACITY, extra={'event': 'startup'})
     app.run(host='0.0.0.0', port=8001, debug=False)
\ No newline at end of file
@@ -0,0 +1,108 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'load_balancer'))
+
+from replication import SharedLoadState
+
+SUBSTATIONS = ['substation_1', 'substation_2']
+
+def make_state(replica_id, epoch=1.0):
+    return SharedLoadState(replica_id, SUBSTATIONS, epoch=epoch)
+
+def test_reservations_count_until_a_later_poll():
+    state = make_state('a')
+    state.record_poll('substation_1', 10.0, 100.0)
+    state.reserve('substation_1', 5.0, 101.0)
+    assert state.effective_load('substation_1') == 15.0
+
+    # The poll at 102 already includes the session reserved at 101
+    state.record_poll('substation_1', 15.0, 102.0)
+    assert state.effective_load('substation_1') == 15.0
+    assert state.reservations['a']['substation_1'] == []
+
+def test_older_poll_is_ignored():
+    state = make_state('a')
+    state.record_poll('substation_1', 20.0, 105.0)
+    state.record_poll('substation_1', 5.0, 100.0)
+    assert state.effective_load('substation_1') == 20.0
+
+def test_cancel_releases_the_reservation():
+    state = make_state('a')
+    state.record_poll('substation_1', 10.0, 100.0)
+    state.effective_load('substation_1')
+    kept = state.reserve('substation_1', 5.0, 101.0)
+    dropped = state.reserve('substation_1', 7.0, 101.5)
+    state.cancel('substation_1', dropped)
+    assert state.effective_load('substation_1') == 15.0
+
+    # Cancelling twice, or a token already pruned by a poll, changes nothing
+    state.cancel('substation_1', dropped)
+    state.record_poll('substation_1', 15.0, 102.0)
+    state.cancel('substation_1', kept)
+    assert state.effective_load('substation_1') == 15.0
+
+def test_merge_adds_peer_reservations_and_fresher_polls():
+    a, b = make_state('a'), make_state('b')
+    a.record_poll('substation_1', 10.0, 100.0)
+    b.record_poll('substation_1', 12.0, 101.0)
+    b.reserve('substation_1', 6.0, 101.5)
+    a.reserve('substation_2', 4.0, 101.5)
+
+    a.merge(b.snapshot(), now=102.0)
+    assert a.effective_load('substation_1') == 18.0
+    assert a.effective_load('substation_2') == 4.0
+    assert a.peers['b'][0] == (1.0, b.version)
+
+def test_merge_ignores_stale_and_duplicate_versions():
+    a, b = make_state('a'), make_state('b')
+    b.reserve('substation_1', 6.0, 101.0)
+    stale = b.snapshot()
+    b.cancel('substation_1', b.reservations['b']['substation_1'][0])
+    current = b.snapshot()
+
+    a.merge(current, now=102.0)
+    a.merge(stale, now=103.0)
+    assert a.effective_load('substation_1') == 0.0
+    # A stale payload still counts as hearing from the peer
+    assert a.peers['b'][1] == 103.0
+
+    a.merge(current, now=104.0)
+    assert a.effective_load('substation_1') == 0.0
+
+def test_restarted_peer_with_lower_version_is_accepted():
+    a = make_state('a')
+    before = make_state('b', epoch=1.0)
+    for i in range(5):
+        before.reserve('substation_1', 1.0, 100.0 + i)
+    a.merge(before.snapshot(), now=105.0)
+    assert a.effective_load('substation_1') == 5.0
+
+    # The restarted replica starts again at version 0, under a newer epoch
+    after = make_state('b', epoch=2.0)
+    after.reserve('substation_1', 3.0, 106.0)
+    a.merge(after.snapshot(), now=107.0)
+    assert a.effective_load('substation_1') == 3.0
+
+def test_own_payload_is_ignored():
+    a = make_state('a')
+    a.reserve('substation_1', 5.0, 101.0)
+    a.merge(a.snapshot(), now=102.0)
+    assert a.peers == {}
+    assert a.effective_load('substation_1') == 5.0
+
+def test_expired_peer_reservations_are_dropped():
+    a, b = make_state('a'), make_state('b')
+    b.reserve('substation_1', 6.0, 101.0)
+    a.merge(b.snapshot(), now=102.0)
+    a.expire_peers(now=102.0 + a.peer_ttl + 1)
+    assert 'b' not in a.peers
+    assert a.effective_load('substation_1') == 0.0
+
+def test_cluster_counters_sum_every_replica():
+    a, b = make_state('a'), make_state('b')
+    a.record_result()
+    b.record_result(over_admitted=True)
+    b.record_result()
+    a.merge(b.snapshot(), now=100.0)
+    assert a.cluster_counters() == {'requests': 3, 'over_admissions': 1}
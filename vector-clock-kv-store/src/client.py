@@ -1,5 +1,6 @@
 import requests
 import sys
+from urllib.parse import quote
 
 def main():
     if len(sys.argv) < 3:
@@ -22,7 +23,7 @@ def main():
             print("Usage: python client.py <node_url> read <key>")
             return
         key = sys.argv[3]
-        response = requests.get(f"{node_url}/read/{key}")
+        response = requests.get(f"{node_url}/read/{quote(key, safe='')}")
         print(response.json())
     else:
         print("Invalid command")
@@ -0,0 +1,86 @@
+import threading
+
+class VectorClock:
+    def __init__(self, node_id, node_count):
+        self.node_id = node_id
+        self.clock = [0] * node_count 
+        
+    def increment(self):
+        self.clock[self.node_id] += 1
+        
+    def update(self, received_clock):
+        for i in range(len(self.clock)):
+            self.clock[i] = max(self.clock[i], received_clock[i])
+        
+    def __str__(self):
+        return str(self.clock)
+
+class KVStore:
+    def __init__(self, node_id, node_count, on_deliver=None):
+        self.node_id = node_id
+        self.store = {}
+        self.vector_clock = VectorClock(node_id, node_count)
+        self.pending_messages = []
+        self.lock = threading.Lock()
+        # Optional callback invoked with every write applied locally or delivered from a peer
+        self.on_deliver = on_deliver
+        
+    def handle_local_write(self, key, value):
+        with self.lock:
+            self.vector_clock.increment()
+            self.store[key] = value
+            message = {
+                'key': key,
+                'value': value,
+                'vector_clock': list(self.vector_clock.clock),
+                'node_id': self.node_id
+            }
+            if self.on_deliver:
+                self.on_deliver(message)
+            return message
+            
+    def is_duplicate(self, message):
+        # The sender's entry counts its writes we have already applied
+        return message['vector_clock'][message['node_id']] <= self.vector_clock.clock[message['node_id']]
+            
+    def can_deliver(self, message):
+        # Deliver the sender's writes in order, after everything the sender had seen
+        sender = message['node_id']
+        for i in range(len(self.vector_clock.clock)):
+            if i == sender:
+                if message['vector_clock'][i] != self.vector_clock.clock[i] + 1:
+                    return False
+            elif self.vector_clock.clock[i] < message['vector_clock'][i]:
+                return False
+        return True
+            
+    def apply_message(self, message):
+        self.store[message['key']] = message['value']
+        self.vector_clock.update(message['vector_clock'])
+        if self.on_deliver:
+            self.on_deliver(message)
+            
+    def handle_received_write(self, message):
+        with self.lock:
+            if self.is_duplicate(message):
+                return
+            
+            # Check if we can apply this message immediately
+            if self.can_deliver(message):
+                self.apply_message(message)
+                # Check if pending messages can now be applied
+                self.process_pending_messages()
+            else:
+                self.pending_messages.append(message)
+                
+    def process_pending_messages(self):
+        delivered = True
+        while delivered:
+            delivered = False
+            for msg in list(self.pending_messages):
+                if self.is_duplicate(msg):
+                    self.pending_messages.remove(msg)
+                elif self.can_deliver(msg):
+                    self.apply_message(msg)
+                    self.pending_messages.remove(msg)
+                    delivered = True
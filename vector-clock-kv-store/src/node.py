@@ -1,99 +1,205 @@
 import json
+import os
+import queue
 import threading
+import time
+import requests
+from urllib.parse import quote
 from flask import Flask, request, jsonify
 from collections import defaultdict
+from partitioning import HashRing, PartitionedStore
 
 app = Flask(__name__)
 
-class VectorClock:
-    def __init__(self, node_id, node_count):
-        self.node_id = node_id
-        self.clock = [0] * node_count 
-        
-    def increment(self):
-        self.clock[self.node_id] += 1
-        
-    def update(self, received_clock):
-        for i in range(len(self.clock)):
-            self.clock[i] = max(self.clock[i], received_clock[i])
-        
-    def __str__(self):
-        return str(self.clock)
-
-class KVStore:
-    def __init__(self, node_id, node_count):
+NODE_ID = int(os.getenv('NODE_ID', 0))
+# Node i is reachable at the i-th URL
+NODE_URLS = os.getenv('NODE_URLS', 'http://node1:5000,http://node2:5000,http://node3:5000').split(',')
+REPLICATION_FACTOR = int(os.getenv('REPLICATION_FACTOR', 3))
+VNODES = int(os.getenv('VNODES', 64))
+STREAM_BATCH_SIZE = 500
+REPLICATION_MAX_BACKOFF = float(os.getenv('REPLICATION_MAX_BACKOFF', 5))
+JOIN_ATTEMPTS = 5
+HANDOFF_RETRY_INTERVAL = float(os.getenv('HANDOFF_RETRY_INTERVAL', 5))
+
+# A joining node (JOIN=1) lists itself last in NODE_URLS and announces itself to the others
+node_urls = dict(enumerate(NODE_URLS))
+kv_store = PartitionedStore(NODE_ID, HashRing(node_urls, vnodes=VNODES, replication_factor=REPLICATION_FACTOR))
+replication_queues = {}
+replication_lock = threading.Lock()
+handoff_lock = threading.Lock()
+
+class ReplicationQueue:
+    """
+    Delivers our writes to one peer in order, retrying each with backoff until the peer
+    acknowledges it. Causal delivery holds back every later write from us behind a missing
+    one, so a write is never dropped; duplicates from retries are discarded by the peer.
+    """
+    def __init__(self, node_id):
         self.node_id = node_id
-        self.store = {}
-        self.vector_clock = VectorClock(node_id, node_count)
-        self.pending_messages = []
-        self.lock = threading.Lock()
-        
-    def handle_local_write(self, key, value):
-        with self.lock:
-            self.vector_clock.increment()
-            self.store[key] = value
-            return {
-                'key': key,
-                'value': value,
-                'vector_clock': self.vector_clock.clock,
-                'node_id': self.node_id
-            }
-            
-    def handle_received_write(self, message):
-        with self.lock:
-            # Check if we can apply this message immediately
-            can_apply = True
-            for i in range(len(self.vector_clock.clock)):
-                if i != message['node_id'] and self.vector_clock.clock[i] < message['vector_clock'][i]:
-                    can_apply = False
-                    break
-            
-            if can_apply:
-                self.store[message['key']] = message['value']
-                self.vector_clock.update(message['vector_clock'])
-                # Check if pending messages can now be applied
-                self.process_pending_messages()
-            else:
-                self.pending_messages.append(message)
-                
-    def process_pending_messages(self):
-        for msg in list(self.pending_messages):
-            can_apply = True
-            for i in range(len(self.vector_clock.clock)):
-                if i != msg['node_id'] and self.vector_clock.clock[i] < msg['vector_clock'][i]:
-                    can_apply = False
-                    break
-            if can_apply:
-                self.store[msg['key']] = msg['value']
-                self.vector_clock.update(msg['vector_clock'])
-                self.pending_messages.remove(msg)
-                self.process_pending_messages()  
+        self.messages = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
 
-kv_store = KVStore(0, 3)
+    def put(self, message):
+        self.messages.put(message)
+
+    def run(self):
+        while True:
+            message = self.messages.get()
+            delay = 0.1
+            while not self.send(message):
+                time.sleep(delay)
+                delay = min(delay * 2, REPLICATION_MAX_BACKOFF)
+
+    def send(self, message):
+        url = node_urls[self.node_id]
+        try:
+            response = requests.post(f"{url}/replicate", json=message, timeout=5)
+        except requests.RequestException as e:
+            app.logger.warning(f"Replication to {url} failed, retrying: {e}")
+            return False
+        if response.status_code >= 500:
+            app.logger.warning(f"Replication to {url} failed with {response.status_code}, retrying")
+            return False
+        # A 409 means the peer is no longer a replica of the group; retrying cannot help
+        return True
+
+def send_replica(node_id, message):
+    with replication_lock:
+        if node_id not in replication_queues:
+            replication_queues[node_id] = ReplicationQueue(node_id)
+        replication_queue = replication_queues[node_id]
+    replication_queue.put(message)
+
+def forward(group, method, path, payload=None):
+    # Any replica of the key's group can serve it; try them in order
+    for node_id in group:
+        try:
+            response = requests.request(method, f"{node_urls[node_id]}{path}", json=payload,
+                                        headers={'X-Forwarded': '1'}, timeout=5)
+            return jsonify(response.json()), response.status_code
+        except requests.RequestException:
+            continue
+    return jsonify({'error': 'No replica reachable', 'group': list(group)}), 503
 
 @app.route('/write', methods=['POST'])
 def write_local():
     data = request.json
+    group = kv_store.group_for(data['key'])
+    if NODE_ID not in group:
+        if request.headers.get('X-Forwarded'):
+            return jsonify({'error': 'Not a replica for this key', 'group': list(group)}), 409
+        return forward(group, 'POST', '/write', data)
+
     message = kv_store.handle_local_write(data['key'], data['value'])
+    for node_id in group:
+        if node_id != NODE_ID:
+            send_replica(node_id, message)
     return jsonify(message)
 
 @app.route('/replicate', methods=['POST'])
 def replicate():
     message = request.json
-    kv_store.handle_received_write(message)
+    try:
+        kv_store.handle_received_write(message)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
     return jsonify({'status': 'success'})
 
-@app.route('/read/<key>', methods=['GET'])
+@app.route('/read/<path:key>', methods=['GET'])
 def read(key):
+    group = kv_store.group_for(key)
+    if NODE_ID not in group:
+        if request.headers.get('X-Forwarded'):
+            return jsonify({'error': 'Not a replica for this key', 'group': list(group)}), 409
+        return forward(group, 'GET', f"/read/{quote(key, safe='')}")
+
+    value, clock = kv_store.read(key)
     return jsonify({
         'key': key,
-        'value': kv_store.store.get(key),
-        'vector_clock': kv_store.vector_clock.clock
+        'value': value,
+        'vector_clock': clock,
+        'group': list(group)
     })
 
+@app.route('/join', methods=['POST'])
+def join():
+    data = request.json
+    node_id = int(data['node_id'])
+    node_urls[node_id] = data['url']
+    # A repeated join moves nothing new but streams whatever the last attempt left behind
+    kv_store.add_node(node_id)
+    streamed, failed = stream_handoffs()
+    if failed:
+        return jsonify({'status': 'pending', 'node_id': node_id, 'keys_streamed': streamed,
+                        'failed': sorted(failed)}), 503
+    return jsonify({'status': 'joined', 'node_id': node_id, 'keys_streamed': streamed})
+
+@app.route('/stream', methods=['POST'])
+def stream():
+    data = request.json
+    try:
+        kv_store.install(data['group'], data['items'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify({'status': 'success', 'keys': len(data['items'])})
+
+def stream_handoffs():
+    """
+    Stream keys moved by a join to their new replicas. Keys leave the handoff only once the
+    target acknowledges them; a target that fails is skipped until the next attempt.
+    Returns the number of keys streamed and the targets that failed.
+    """
+    streamed = 0
+    failed = set()
+    with handoff_lock:
+        for (target, group), items in kv_store.pending_handoffs().items():
+            if target in failed:
+                continue
+            keys = list(items)
+            for start in range(0, len(keys), STREAM_BATCH_SIZE):
+                batch = {key: items[key] for key in keys[start:start + STREAM_BATCH_SIZE]}
+                try:
+                    response = requests.post(f"{node_urls[target]}/stream", json={'group': list(group), 'items': batch},
+                                             timeout=30)
+                    response.raise_for_status()
+                except requests.RequestException as e:
+                    app.logger.warning(f"Streaming {len(batch)} keys to node {target} failed: {e}")
+                    failed.add(target)
+                    break
+                kv_store.acknowledge_handoff(target, group, batch)
+                streamed += len(batch)
+    return streamed, failed
+
+def retry_handoffs():
+    # Picks up handoffs a failed join left behind and writes delivered after a join
+    while True:
+        time.sleep(HANDOFF_RETRY_INTERVAL)
+        try:
+            if kv_store.pending_handoffs():
+                stream_handoffs()
+        except Exception as e:
+            app.logger.error(f"Error streaming handoffs: {e}")
+
+def announce_join():
+    # Existing nodes add us to their ring and stream the keys we now replicate.
+    # Each node is retried on its own so one unreachable node does not stop the others
+    for node_id, url in list(node_urls.items()):
+        if node_id == NODE_ID:
+            continue
+        for attempt in range(1, JOIN_ATTEMPTS + 1):
+            try:
+                response = requests.post(f"{url}/join", json={'node_id': NODE_ID, 'url': node_urls[NODE_ID]}, timeout=60)
+                response.raise_for_status()
+                break
+            except requests.RequestException as e:
+                app.logger.warning(f"Join announcement to {url} failed (attempt {attempt}/{JOIN_ATTEMPTS}): {e}")
+                if attempt < JOIN_ATTEMPTS:
+                    time.sleep(2 ** attempt)
+        else:
+            app.logger.error(f"Node {node_id} at {url} did not learn of our join; its ring is missing node {NODE_ID}")
+
 if __name__ == '__main__':
-    import os
-    node_id = int(os.getenv('NODE_ID', 0))
-    kv_store.node_id = node_id
-    kv_store.vector_clock = VectorClock(node_id, 3)
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    threading.Thread(target=retry_handoffs, daemon=True).start()
+    if os.getenv('JOIN') == '1':
+        threading.Timer(1.0, announce_join).start()
+    app.run(host='0.0.0.0', port=5000, threaded=True)
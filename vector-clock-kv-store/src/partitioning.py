@@ -0,0 +1,187 @@
+import bisect
+import hashlib
+import threading
+from collections import deque
+from kvstore import KVStore
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+class HashRing:
+    def __init__(self, node_ids=(), vnodes=64, replication_factor=3):
+        self.vnodes = vnodes
+        self.replication_factor = replication_factor
+        # (node ids, sorted ring positions, owner of each position), replaced as a whole
+        # so concurrent readers never see a half-updated ring
+        self.points = (frozenset(), [], [])
+        for node_id in node_ids:
+            self.add_node(node_id)
+
+    @property
+    def node_ids(self):
+        return self.points[0]
+
+    def add_node(self, node_id):
+        node_ids, tokens, owners = self.points
+        if node_id in node_ids:
+            return
+        entries = list(zip(tokens, owners))
+        entries.extend((ring_hash(f"{node_id}#{i}"), node_id) for i in range(self.vnodes))
+        entries.sort()
+        self.points = (node_ids | {node_id}, [token for token, _ in entries], [owner for _, owner in entries])
+
+    def remove_node(self, node_id):
+        node_ids, tokens, owners = self.points
+        if node_id not in node_ids:
+            return
+        entries = [(token, owner) for token, owner in zip(tokens, owners) if owner != node_id]
+        self.points = (node_ids - {node_id}, [token for token, _ in entries], [owner for _, owner in entries])
+
+    def replica_group(self, key):
+        # The first R distinct nodes clockwise from the key, sorted so the group
+        # (and the vector clock indices derived from it) is the same on every node
+        node_ids, tokens, owners = self.points
+        group = []
+        count = min(self.replication_factor, len(node_ids))
+        index = bisect.bisect(tokens, ring_hash(key))
+        while len(group) < count:
+            owner = owners[index % len(owners)]
+            if owner not in group:
+                group.append(owner)
+            index += 1
+        return tuple(sorted(group))
+
+class PartitionedStore:
+    """
+    Holds the keys this node replicates. Causal metadata is scoped to each replica group:
+    every group this node belongs to gets its own KVStore, whose vector clock only has
+    entries for the group's members.
+
+    When a join changes a key's group, the key leaves the old group's store. Copies bound
+    for members of the new group that did not hold it wait in the handoff until the target
+    acknowledges them. Writes for an old group that are delivered after the join are moved
+    the same way.
+    """
+    def __init__(self, node_id, ring):
+        self.node_id = node_id
+        self.ring = ring
+        self.groups = {}
+        # group -> keys written through the group itself, which streamed copies never overwrite
+        self.written = {}
+        # (target node, group) -> {key: value} not yet acknowledged by the target
+        self.handoff = {}
+        # (group, key) delivered to a group that no longer replicates the key
+        self.strays = deque()
+        self.lock = threading.Lock()
+
+    def group_for(self, key):
+        return self.ring.replica_group(key)
+
+    def owns(self, key):
+        return self.node_id in self.group_for(key)
+
+    def group_store(self, group):
+        group = tuple(group)
+        if self.node_id not in group:
+            raise ValueError(f"node {self.node_id} is not a replica of group {list(group)}")
+        with self.lock:
+            if group not in self.groups:
+                self.written[group] = set()
+                self.groups[group] = KVStore(group.index(self.node_id), len(group),
+                                             on_deliver=lambda message: self._delivered(group, message))
+            return self.groups[group]
+
+    def _delivered(self, group, message):
+        # Called by the group's KVStore with its lock held
+        key = message['key']
+        if self.group_for(key) == group:
+            self.written[group].add(key)
+        else:
+            self.strays.append((group, key))
+
+    def handle_local_write(self, key, value):
+        group = self.group_for(key)
+        message = self.group_store(group).handle_local_write(key, value)
+        message['group'] = list(group)
+        self._move_strays()
+        return message
+
+    def handle_received_write(self, message):
+        self.group_store(message['group']).handle_received_write(message)
+        self._move_strays()
+
+    def read(self, key):
+        group = self.group_for(key)
+        store = self.group_store(group)
+        with store.lock:
+            return store.store.get(key), list(store.vector_clock.clock)
+
+    def install(self, group, items):
+        # Streamed keys become base state of the group; they carry no causal history, and
+        # anything written through the group since is newer than them
+        store = self.group_store(group)
+        with store.lock:
+            written = self.written[tuple(group)]
+            for key, value in items.items():
+                if key not in written:
+                    store.store[key] = value
+
+    def add_node(self, node_id):
+        """
+        Add a node to the ring and move keys whose replica group changed.
+        Adding a node that is already in the ring moves nothing; the handoff it left
+        behind is still in pending_handoffs().
+        """
+        with self.lock:
+            self.ring.add_node(node_id)
+            old_groups = list(self.groups.items())
+
+        for old_group, store in old_groups:
+            with store.lock:
+                moved = {key: value for key, value in store.store.items() if self.group_for(key) != old_group}
+                for key in moved:
+                    del store.store[key]
+                    self.written[old_group].discard(key)
+            self._move(old_group, moved)
+
+    def pending_handoffs(self):
+        """{(target node, group): {key: value}} still to be streamed"""
+        with self.lock:
+            return {destination: dict(items) for destination, items in self.handoff.items()}
+
+    def acknowledge_handoff(self, target, group, items):
+        """Drop streamed keys from the handoff, unless a newer value replaced them meanwhile"""
+        destination = (target, tuple(group))
+        with self.lock:
+            pending = self.handoff.get(destination, {})
+            for key, value in items.items():
+                if key in pending and pending[key] == value:
+                    del pending[key]
+            if not pending:
+                self.handoff.pop(destination, None)
+
+    def _move(self, old_group, moved):
+        for key, value in moved.items():
+            new_group = self.group_for(key)
+            if self.node_id in new_group:
+                self.install(new_group, {key: value})
+            # Only the lowest id of the old group hands off, so each receiver gets a key once
+            if self.node_id == min(old_group):
+                with self.lock:
+                    for target in new_group:
+                        if target not in old_group:
+                            self.handoff.setdefault((target, new_group), {})[key] = value
+
+    def _move_strays(self):
+        while self.strays:
+            try:
+                group, key = self.strays.popleft()
+            except IndexError:
+                return
+            store = self.groups[group]
+            with store.lock:
+                if key not in store.store or self.group_for(key) == group:
+                    continue
+                value = store.store.pop(key)
+                self.written[group].discard(key)
+            self._move(group, {key: value})
@@ -0,0 +1,190 @@
+"""
+Deterministic in-process cluster simulator and benchmark for the causal KV store.
+
+Runs N KVStore instances in one process, connected by a simulated network with
+configurable delay, reordering, duplication and drops, and drives them with a
+seeded write workload. Every run with the same seed replays exactly.
+
+Usage: python simulator.py [--nodes N] [--writes W] [--seed S] [--scenario NAME]
+"""
+import argparse
+import heapq
+import random
+import time
+import tracemalloc
+from kvstore import KVStore
+
+class NetworkConfig:
+    def __init__(self, min_delay=0.001, max_delay=0.005, reorder=0.0, reorder_delay=0.05,
+                 duplicate=0.0, drop=0.0, retransmit_timeout=0.2):
+        # Delays are in virtual seconds
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # Probability that a message is held back by up to reorder_delay extra
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate
+        # Dropped transmissions are retried by the sender after retransmit_timeout
+        self.drop = drop
+        self.retransmit_timeout = retransmit_timeout
+
+SCENARIOS = {
+    'lan': NetworkConfig(),
+    'reorder': NetworkConfig(reorder=0.3),
+    'lossy': NetworkConfig(reorder=0.1, duplicate=0.1, drop=0.1),
+    'wan': NetworkConfig(min_delay=0.05, max_delay=0.2, reorder=0.2, reorder_delay=0.3, duplicate=0.02, drop=0.02),
+}
+
+class SimulatedNetwork:
+    def __init__(self, config, rng):
+        self.config = config
+        self.rng = rng
+        self.events = []
+        self.sequence = 0
+        self.transmissions = 0
+
+    def schedule(self, at, event):
+        # The sequence number keeps ordering deterministic for events at the same time
+        heapq.heappush(self.events, (at, self.sequence, event))
+        self.sequence += 1
+
+    def send(self, now, destination, message):
+        config = self.config
+        self.transmissions += 1
+        if self.rng.random() < config.drop:
+            self.schedule(now + config.retransmit_timeout, ('retransmit', destination, message))
+            return
+
+        copies = 2 if self.rng.random() < config.duplicate else 1
+        for _ in range(copies):
+            delay = self.rng.uniform(config.min_delay, config.max_delay)
+            if self.rng.random() < config.reorder:
+                delay += self.rng.uniform(0, config.reorder_delay)
+            self.schedule(now + delay, ('deliver', destination, message))
+
+class Cluster:
+    def __init__(self, node_count, network):
+        self.network = network
+        self.nodes = [KVStore(i, node_count, on_deliver=self._checker(i)) for i in range(node_count)]
+        # delivered[i][j] counts writes from node j applied at node i, tracked independently of the stores
+        self.delivered = [[0] * node_count for _ in range(node_count)]
+        self.violations = []
+        self.deliveries = 0
+        self.pending_high_water = 0
+
+    def _checker(self, node_id):
+        def check(message):
+            seen = self.delivered[node_id]
+            origin = message['node_id']
+            clock = message['vector_clock']
+            for j, count in enumerate(seen):
+                if (j == origin and count != clock[j] - 1) or (j != origin and count < clock[j]):
+                    self.violations.append((node_id, origin, list(clock), list(seen)))
+                    break
+            seen[origin] += 1
+            self.deliveries += 1
+        return check
+
+    def write(self, now, node_id, key, value):
+        message = self.nodes[node_id].handle_local_write(key, value)
+        for destination in range(len(self.nodes)):
+            if destination != node_id:
+                self.network.send(now, destination, message)
+
+    def receive(self, destination, message):
+        node = self.nodes[destination]
+        node.handle_received_write(message)
+        self.pending_high_water = max(self.pending_high_water, len(node.pending_messages))
+
+    def converged(self, writes_per_node):
+        return all(node.vector_clock.clock == writes_per_node and not node.pending_messages
+                   for node in self.nodes)
+
+    def divergent_keys(self):
+        # Concurrent writes to the same key are not reconciled, so replicas may keep different values
+        keys = set().union(*(node.store for node in self.nodes))
+        return sum(1 for key in keys if len({repr(node.store.get(key)) for node in self.nodes}) > 1)
+
+def generate_workload(node_count, writes, write_rate, key_count, rng):
+    """Seeded (time, node, key, value) writes arriving as a Poisson process"""
+    workload = []
+    now = 0.0
+    for seq in range(writes):
+        now += rng.expovariate(write_rate)
+        node_id = rng.randrange(node_count)
+        workload.append((now, node_id, f"key{rng.randrange(key_count)}", f"{node_id}:{seq}"))
+    return workload
+
+def run_simulation(node_count=3, writes=10000, seed=0, config=None, write_rate=1000.0, key_count=100):
+    """Run one seeded simulation and return its metrics"""
+    rng = random.Random(seed)
+    network = SimulatedNetwork(config or NetworkConfig(), rng)
+    cluster = Cluster(node_count, network)
+    workload = generate_workload(node_count, writes, write_rate, key_count, rng)
+    for at, node_id, key, value in workload:
+        network.schedule(at, ('write', node_id, (key, value)))
+
+    writes_per_node = [0] * node_count
+    for _, node_id, _, _ in workload:
+        writes_per_node[node_id] += 1
+    last_write = workload[-1][0] if workload else 0.0
+
+    now = 0.0
+    started = time.perf_counter()
+    while network.events:
+        now, _, (kind, node_id, payload) = heapq.heappop(network.events)
+        if kind == 'write':
+            cluster.write(now, node_id, *payload)
+        elif kind == 'retransmit':
+            network.send(now, node_id, payload)
+        else:
+            cluster.receive(node_id, payload)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'nodes': node_count,
+        'writes': writes,
+        'wall_seconds': elapsed,
+        'writes_per_second': writes / elapsed if elapsed else 0.0,
+        'deliveries_per_second': cluster.deliveries / elapsed if elapsed else 0.0,
+        'transmissions': network.transmissions,
+        'convergence_time': now - last_write,
+        'converged': cluster.converged(writes_per_node),
+        'pending_high_water': cluster.pending_high_water,
+        'causal_violations': len(cluster.violations),
+        'divergent_keys': cluster.divergent_keys(),
+    }
+
+def measure_memory(**kwargs):
+    """Peak traced memory in bytes for a run; deterministic seeds make this the same run as the timed one"""
+    tracemalloc.start()
+    try:
+        run_simulation(**kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchmark(scenarios, node_count, writes, seed):
+    print(f"{'scenario':<10} {'writes/s':>10} {'deliv/s':>10} {'converge(s)':>12} "
+          f"{'pending hwm':>12} {'peak MiB':>9} {'violations':>10} {'divergent':>9}")
+    for name in scenarios:
+        kwargs = dict(node_count=node_count, writes=writes, seed=seed, config=SCENARIOS[name])
+        result = run_simulation(**kwargs)
+        peak = measure_memory(**kwargs)
+        status = '' if result['converged'] else '  NOT CONVERGED'
+        print(f"{name:<10} {result['writes_per_second']:>10.0f} {result['deliveries_per_second']:>10.0f} "
+              f"{result['convergence_time']:>12.3f} {result['pending_high_water']:>12} "
+              f"{peak / 2**20:>9.2f} {result['causal_violations']:>10} {result['divergent_keys']:>9}{status}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Causal KV store cluster simulator')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--writes', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append',
+                        help='network scenario to run (repeatable, default: all)')
+    args = parser.parse_args()
+    benchmark(args.scenario or list(SCENARIOS), args.nodes, args.writes, args.seed)
+
+if __name__ == '__main__':
+    main()
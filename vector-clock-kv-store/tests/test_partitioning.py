@@ -0,0 +1,133 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from partitioning import HashRing, PartitionedStore
+
+KEYS = [f"key-{i}" for i in range(300)]
+
+def make_cluster(node_ids, replication_factor=2):
+    return {node_id: PartitionedStore(node_id, HashRing(node_ids, vnodes=16, replication_factor=replication_factor))
+            for node_id in node_ids}
+
+def write(cluster, key, value, deliver=True, writer=None):
+    """Write at a member of the key's group (the lowest by default) and replicate to the others"""
+    group = cluster[min(cluster)].group_for(key)
+    writer = group[0] if writer is None else writer
+    message = cluster[writer].handle_local_write(key, value)
+    if deliver:
+        for node_id in group:
+            if node_id != writer:
+                cluster[node_id].handle_received_write(message)
+    return message
+
+def join(cluster, node_id, replication_factor=2, fail=()):
+    """Add a node everywhere and stream handoffs, except to the targets in `fail`"""
+    node_ids = sorted(cluster) + [node_id]
+    cluster[node_id] = PartitionedStore(node_id, HashRing(node_ids, vnodes=16, replication_factor=replication_factor))
+    for existing in node_ids[:-1]:
+        cluster[existing].add_node(node_id)
+    stream_handoffs(cluster, fail)
+
+def stream_handoffs(cluster, fail=()):
+    for store in list(cluster.values()):
+        for (target, group), items in store.pending_handoffs().items():
+            if target in fail:
+                continue
+            cluster[target].install(group, items)
+            store.acknowledge_handoff(target, group, items)
+
+def assert_every_replica_has(cluster, values):
+    ring = cluster[min(cluster)].ring
+    for key, value in values.items():
+        for node_id in ring.replica_group(key):
+            assert cluster[node_id].read(key)[0] == value, (key, node_id)
+
+def test_replica_group_is_sorted_and_independent_of_insertion_order():
+    forward = HashRing([0, 1, 2, 3], vnodes=16, replication_factor=3)
+    backward = HashRing([3, 2, 1, 0], vnodes=16, replication_factor=3)
+    for key in KEYS:
+        group = forward.replica_group(key)
+        assert group == backward.replica_group(key)
+        assert list(group) == sorted(set(group))
+        assert len(group) == 3
+
+def test_replica_group_is_capped_by_ring_size():
+    ring = HashRing([0, 1], replication_factor=3)
+    assert ring.replica_group('key') == (0, 1)
+
+def test_join_only_moves_keys_to_the_new_node():
+    ring = HashRing([0, 1, 2], vnodes=16, replication_factor=2)
+    before = {key: ring.replica_group(key) for key in KEYS}
+    ring.add_node(3)
+    moved = 0
+    for key in KEYS:
+        after = ring.replica_group(key)
+        assert set(after) <= set(before[key]) | {3}
+        moved += after != before[key]
+    assert 0 < moved < len(KEYS)
+
+def test_every_moved_key_reaches_its_new_replicas():
+    cluster = make_cluster([0, 1, 2])
+    values = {key: f"v-{key}" for key in KEYS}
+    for key, value in values.items():
+        write(cluster, key, value)
+
+    join(cluster, 3)
+    assert_every_replica_has(cluster, values)
+    assert all(not store.pending_handoffs() for store in cluster.values())
+
+def test_every_moved_key_survives_with_a_single_replica():
+    cluster = make_cluster([0, 1, 2], replication_factor=1)
+    values = {key: f"v-{key}" for key in KEYS}
+    for key, value in values.items():
+        write(cluster, key, value)
+
+    join(cluster, 3, replication_factor=1)
+    assert_every_replica_has(cluster, values)
+
+def test_failed_stream_is_kept_and_sent_on_a_repeated_join():
+    cluster = make_cluster([0, 1, 2])
+    values = {key: f"v-{key}" for key in KEYS}
+    for key, value in values.items():
+        write(cluster, key, value)
+
+    join(cluster, 3, fail={3})
+    assert any(store.pending_handoffs() for store in cluster.values())
+    assert any(cluster[3].read(key)[0] is None for key in values if 3 in cluster[3].group_for(key))
+
+    # The joiner retries: the ring is unchanged, but the handoff is still there to stream
+    for existing in (0, 1, 2):
+        cluster[existing].add_node(3)
+    stream_handoffs(cluster)
+    assert_every_replica_has(cluster, values)
+
+def test_streamed_copy_does_not_overwrite_a_newer_write():
+    cluster = make_cluster([0, 1, 2])
+    for key in KEYS:
+        write(cluster, key, 'old')
+    join(cluster, 3, fail={3})
+
+    moved = [key for key in KEYS if 3 in cluster[3].group_for(key)]
+    for key in moved:
+        write(cluster, key, 'new')
+    stream_handoffs(cluster)
+    assert_every_replica_has(cluster, {key: 'new' for key in moved})
+
+def test_write_delivered_after_the_join_reaches_the_new_group():
+    cluster = make_cluster([0, 1, 2])
+    ring = HashRing([0, 1, 2, 3], vnodes=16, replication_factor=2)
+    key = next(key for key in KEYS if 3 in ring.replica_group(key))
+    low, high = cluster[0].group_for(key)
+
+    write(cluster, key, 'first')
+    # The higher member's next write reaches the lower one, which hands the key off,
+    # only after the join
+    late = write(cluster, key, 'second', deliver=False, writer=high)
+    join(cluster, 3)
+    cluster[low].handle_received_write(late)
+    stream_handoffs(cluster)
+
+    assert_every_replica_has(cluster, {key: 'second'})
+    assert key not in cluster[low].groups[(low, high)].store